@@ -0,0 +1,80 @@
+"""
+Check the parity of the encoder backends with PyTorch and compare their latency and throughput.
+
+The cosine drift (1 - cosine similarity to the PyTorch embedding) of every backend is bounded by
+--max-drift (fp32 onnx) and --max-quantized-drift (int8 onnx); the script exits non-zero otherwise.
+
+Run from the `src` directory:
+    python -m benchmarks.encoder_backends --export-dir /tmp/onnx
+"""
+import argparse
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.image_encoding import synthetic_images
+from utils.clip_encoder import CLIPEncoder
+
+QUERIES = ['black dress', 'red running shoes', 'white cotton shirt with long sleeves', 'leather bag',
+           'blue denim jacket', 'summer hat', 'wool scarf', 'silver necklace']
+
+
+def cosine_drift(reference: np.ndarray, embeddings: np.ndarray) -> float:
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return float(np.max(1 - np.sum(reference * embeddings, axis=1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='openai/clip-vit-base-patch32')
+    parser.add_argument('--export-dir', default='data/onnx')
+    parser.add_argument('--images', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--max-drift', type=float, default=1e-4)
+    parser.add_argument('--max-quantized-drift', type=float, default=5e-2)
+    args = parser.parse_args()
+
+    backends = {
+        'torch': dict(backend='torch'),
+        'onnx': dict(backend='onnx', backend_configs={'export_dir': args.export_dir}),
+        'onnx-int8': dict(backend='onnx', backend_configs={'export_dir': args.export_dir, 'quantize': True}),
+    }
+    images = [image for images in synthetic_images(args.images, 1) for image in images]
+
+    reference, failed = None, False
+    for name, configs in backends.items():
+        encoder = CLIPEncoder(model_name=args.model, **configs)
+        text_embeddings = np.array(encoder.encode_texts(QUERIES))
+        image_embeddings = encoder.encode_images(images, batch_size=args.batch_size)
+
+        latencies = []
+        for _ in range(args.repeats):
+            for query in QUERIES:
+                started_at = time.perf_counter()
+                encoder.encode_text(query)
+                latencies.append((time.perf_counter() - started_at) * 1000)
+
+        started_at = time.perf_counter()
+        encoder.encode_images(images, batch_size=args.batch_size)
+        images_per_second = len(images) / (time.perf_counter() - started_at)
+
+        line = (f'{name:>10}: text p50 {statistics.median(latencies):7.2f}ms, '
+                f'images {images_per_second:8.2f}/sec')
+        if reference is None:
+            reference = (text_embeddings, image_embeddings)
+        else:
+            drift = max(cosine_drift(reference[0], text_embeddings), cosine_drift(reference[1], image_embeddings))
+            max_drift = args.max_quantized_drift if configs['backend_configs'].get('quantize') else args.max_drift
+            failed |= drift > max_drift
+            line += f', cosine drift {drift:.2e} ({"ok" if drift <= max_drift else f"above {max_drift:.0e}"})'
+        print(line)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
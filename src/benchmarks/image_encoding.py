@@ -0,0 +1,61 @@
+"""
+Compare per-product image encoding with cross-product batched inference.
+
+Run from the `src` directory:
+    python -m benchmarks.image_encoding --products 64 --images-per-product 3 --batch-size 32
+"""
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from utils.clip_encoder import CLIPEncoder
+
+
+def synthetic_images(num_products: int, images_per_product: int, size: int = 640):
+    rng = np.random.default_rng(0)
+    return [[Image.fromarray(rng.integers(0, 255, (size, size, 3), dtype=np.uint8))
+             for _ in range(images_per_product)]
+            for _ in range(num_products)]
+
+
+def per_product(encoder: CLIPEncoder, products_images):
+    return [encoder.encode_image(images=images, is_url=False) for images in products_images]
+
+
+def batched(encoder: CLIPEncoder, products_images, batch_size: int):
+    flat_images = [image for images in products_images for image in images]
+    return encoder.encode_images(flat_images, batch_size=batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='openai/clip-vit-base-patch32')
+    parser.add_argument('--products', type=int, default=64)
+    parser.add_argument('--images-per-product', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    encoder = CLIPEncoder(model_name=args.model)
+    products_images = synthetic_images(args.products, args.images_per_product)
+    num_images = args.products * args.images_per_product
+
+    # warm up both paths once before timing
+    per_product(encoder, products_images[:1])
+    batched(encoder, products_images[:1], args.batch_size)
+
+    for name, run in (('per_product', lambda: per_product(encoder, products_images)),
+                      ('batched', lambda: batched(encoder, products_images, args.batch_size))):
+        timings = []
+        for _ in range(args.repeats):
+            started_at = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started_at)
+        best = min(timings)
+        print(f'{name:>12}: {num_images / best:8.2f} images/sec ({best:.3f}s for {num_images} images)')
+
+
+if __name__ == '__main__':
+    main()
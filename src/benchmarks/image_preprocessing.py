@@ -0,0 +1,80 @@
+"""
+Check the parity of the NumPy image preprocessing with `CLIPImageProcessor` and compare the
+per-image time of decoding and preprocessing large JPEGs with both, with and without draft decoding.
+
+The largest absolute difference of the pixel values of full-resolution decodes is bounded by
+--max-diff, the script exits non-zero otherwise. Draft decoding changes the decoded pixels,
+its difference is reported but not checked.
+
+Run from the `src` directory:
+    python -m benchmarks.image_preprocessing --images 32 --size 2000
+"""
+import argparse
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+from utils.image_preprocessing import ImagePreprocessor, decode_image
+
+
+def synthetic_jpegs(num_images: int, size: int):
+    rng = np.random.default_rng(0)
+    jpegs = []
+    for index in range(num_images):
+        # smooth gradients plus noise compress like photos, unlike pure noise
+        height, width = size, int(size * (0.75 + 0.5 * (index % 2)))
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        pixels = gradient + rng.normal(0, 20, (height, width, 3))
+        buffer = BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=90)
+        jpegs.append(buffer.getvalue())
+    return jpegs
+
+
+def timed(run) -> float:
+    started_at = time.perf_counter()
+    run()
+    return time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='openai/clip-vit-base-patch32')
+    parser.add_argument('--images', type=int, default=32)
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-diff', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    image_processor = CLIPImageProcessor.from_pretrained(args.model)
+    image_preprocessor = ImagePreprocessor.from_image_processor(image_processor)
+    jpegs = synthetic_jpegs(args.images, args.size)
+
+    def processor(draft_size=None):
+        images = [decode_image(jpeg, draft_size) for jpeg in jpegs]
+        return image_processor(images=images, return_tensors='np')['pixel_values']
+
+    def fast(draft_size=None):
+        return image_preprocessor([decode_image(jpeg, draft_size) for jpeg in jpegs])
+
+    reference = processor()
+    diff = float(np.abs(reference - fast()).max())
+    draft_diff = float(np.abs(reference - fast(image_preprocessor.size)).max())
+
+    for name, run in (('processor', processor),
+                      ('numpy', fast),
+                      ('numpy+draft', lambda: fast(image_preprocessor.size))):
+        best = min(timed(run) for _ in range(args.repeats))
+        print(f'{name:>12}: {best / args.images * 1000:7.2f}ms per image')
+
+    print(f'max pixel difference: {diff:.2e} ({"ok" if diff <= args.max_diff else f"above {args.max_diff:.0e}"}), '
+          f'with draft decoding: {draft_diff:.2e}')
+    sys.exit(0 if diff <= args.max_diff else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Offline end-to-end benchmark of the indexer and the `/search` endpoint.
+
+A synthetic catalog with images served from a local HTTP server is indexed into an in-process
+Qdrant (`QdrantClient(":memory:")`) with a tiny randomly initialized CLIP model, then the search
+API is served from a background thread and queried with semantic, keyword and hybrid searches at
+a fixed concurrency. The hybrid, cache and scheduler settings come from `configuration.yaml`.
+
+Reports indexing images/sec, p50/p95/p99 latency and QPS per retrieval type (single searches and
+`POST /search/batch` requests of --batch-size queries) and the peak RSS, and writes them to
+--output as JSON so runs of different commits can be compared.
+
+Run from the `src` directory:
+    python -m benchmarks.service --products 500 --requests 300 --concurrency 8 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import numpy as np
+import requests
+from flask import Flask
+from PIL import Image
+from werkzeug.serving import make_server
+
+from configs.configs import ConfigManager
+from controllers.api_controller import ApiController
+from controllers.qdrant_manager import QdrantManager
+from models.product import Product
+from models.query import RetrievalType
+from utils.image_downloader import ImageDownloader
+
+COLORS = ['red', 'blue', 'black', 'white', 'green', 'yellow', 'pink', 'grey']
+ITEMS = ['shirt', 'dress', 'jacket', 'shoes', 'bag', 'scarf', 'hat', 'jeans', 'skirt', 'coat']
+MATERIALS = ['cotton', 'leather', 'wool', 'denim', 'silk', 'linen']
+BRANDS = ['acme', 'globex', 'initech', 'umbrella', 'hooli']
+
+
+def build_tiny_clip(path: str) -> str:
+    """Save a randomly initialized CLIP model with a character level tokenizer to `path`"""
+    from transformers import CLIPConfig, CLIPModel, CLIPTokenizerFast, CLIPImageProcessor
+
+    characters = list('abcdefghijklmnopqrstuvwxyz0123456789')
+    vocab = {token: index for index, token in enumerate(characters + [f'{c}</w>' for c in characters])}
+    vocab.update({'<|startoftext|>': len(vocab), '<|endoftext|>': len(vocab) + 1})
+    with open(os.path.join(path, 'vocab.json'), 'w') as vocab_file:
+        json.dump(vocab, vocab_file)
+    with open(os.path.join(path, 'merges.txt'), 'w') as merges_file:
+        merges_file.write('#version: 0.2\n')
+    CLIPTokenizerFast(vocab_file=os.path.join(path, 'vocab.json'),
+                      merges_file=os.path.join(path, 'merges.txt')).save_pretrained(path)
+    CLIPImageProcessor(size={'shortest_edge': 32}, crop_size={'height': 32, 'width': 32}).save_pretrained(path)
+
+    config = CLIPConfig(
+        text_config=dict(vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_attention_heads=2,
+                         num_hidden_layers=2, bos_token_id=vocab['<|startoftext|>'],
+                         eos_token_id=vocab['<|endoftext|>'], pad_token_id=vocab['<|endoftext|>']),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_attention_heads=2, num_hidden_layers=2,
+                           image_size=32, patch_size=8),
+        projection_dim=16,
+    )
+    CLIPModel(config).save_pretrained(path)
+    return path
+
+
+def start_image_server(directory: str, num_images: int, size: int) -> ThreadingHTTPServer:
+    rng = np.random.default_rng(0)
+    for index in range(num_images):
+        pixels = rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(directory, f'{index}.jpg'), quality=85)
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_catalog(num_products: int, images_url: str, num_images: int, images_per_product: int) -> List[Product]:
+    rng = np.random.default_rng(1)
+    products = []
+    for product_id in range(1, num_products + 1):
+        color, item, material = rng.choice(COLORS), rng.choice(ITEMS), rng.choice(MATERIALS)
+        products.append(Product(
+            id=product_id,
+            name=f'{color} {material} {item}',
+            current_price=float(rng.integers(5, 500)),
+            currency='USD',
+            images=[f'{images_url}/{rng.integers(num_images)}.jpg' for _ in range(images_per_product)],
+            brand_name=str(rng.choice(BRANDS)),
+            code=f'P{product_id}',
+            link=f'https://shop.example/products/{product_id}',
+        ))
+    return products
+
+
+def latency_summary(latencies: List[float], elapsed: float) -> Dict:
+    latencies = np.asarray(latencies) * 1000
+    return {'requests': len(latencies),
+            'qps': len(latencies) / elapsed,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99))}
+
+
+def random_queries(num_queries: int) -> List[str]:
+    rng = np.random.default_rng(2)
+    return [f'{rng.choice(COLORS)} {rng.choice(ITEMS)}' for _ in range(num_queries)]
+
+
+def benchmark_search(search_url: str, retrieval_type: RetrievalType, num_requests: int, concurrency: int) -> Dict:
+    queries = random_queries(num_requests)
+    sessions = threading.local()
+
+    def search(query):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        started_at = time.perf_counter()
+        response = sessions.session.get(search_url, params={'query': query,
+                                                           'retrieval_type': int(retrieval_type),
+                                                           'size': 10})
+        response.raise_for_status()
+        return time.perf_counter() - started_at
+
+    search(queries[0])
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(search, queries))
+    return latency_summary(latencies, time.perf_counter() - started_at)
+
+
+def benchmark_batch_search(batch_url: str, retrieval_type: RetrievalType, num_requests: int, concurrency: int,
+                           batch_size: int) -> Dict:
+    """Send the queries in batches, the latency is per request and the QPS counts queries"""
+    queries = random_queries(num_requests)
+    batches = [[{'query': query, 'retrieval_type': int(retrieval_type), 'size': 10}
+                for query in queries[start:start + batch_size]]
+               for start in range(0, len(queries), batch_size)]
+    sessions = threading.local()
+
+    def search(batch):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        started_at = time.perf_counter()
+        response = sessions.session.post(batch_url, json=batch)
+        response.raise_for_status()
+        return time.perf_counter() - started_at
+
+    search(batches[0])
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(search, batches))
+    summary = latency_summary(latencies, time.perf_counter() - started_at)
+    summary['qps'] = len(queries) / (summary['requests'] / summary['qps'])
+    return dict(summary, batch_size=batch_size)
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--images', type=int, default=200, help='distinct images served')
+    parser.add_argument('--images-per-product', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=256)
+    parser.add_argument('--requests', type=int, default=300, help='requests per retrieval type')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=16, help='queries per /search/batch request')
+    parser.add_argument('--model', help='CLIP model to use instead of a tiny random one')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    config_manager = ConfigManager.get_config_manager()
+    job_configs = config_manager.get_prop('insertion_job_configs')
+    work_dir = tempfile.mkdtemp(prefix='clip-search-benchmark-')
+    model_name = args.model or build_tiny_clip(work_dir)
+
+    image_server = start_image_server(tempfile.mkdtemp(dir=work_dir), args.images, args.image_size)
+    images_url = f'http://127.0.0.1:{image_server.server_address[1]}'
+    products = synthetic_catalog(args.products, images_url, args.images, args.images_per_product)
+
+    qdrant_configs = dict(config_manager.get_prop('qdrant_configs'),
+                          db_url=':memory:', db_api_key=None, vector_store='qdrant')
+    encoder_configs = dict(config_manager.get_prop('encoder_configs'), model_name=model_name, backend='torch')
+    encoder_configs.pop('serving_mode', None)
+    encoder_configs.pop('indexing_mode', None)
+    api_controller = ApiController(qdrant_configs=qdrant_configs,
+                                   hybrid_search_configs=config_manager.get_prop('hybrid_search_configs'),
+                                   text_cache_configs=config_manager.get_prop('text_cache_configs'),
+                                   inference_scheduler_configs=config_manager.get_prop('inference_scheduler_configs'),
+                                   encoder_configs=dict(encoder_configs, mode='full'))
+    qdrant_manager: QdrantManager = api_controller.qdrant_manager
+
+    image_downloader = ImageDownloader(**{key: value for key, value in job_configs['download_configs'].items()
+                                          if key != 'draft_decoding'})
+    started_at = time.perf_counter()
+    qdrant_manager.insert_batch(products,
+                                insertion_batch_size=job_configs['insertion_batch_size'],
+                                image_downloader=image_downloader,
+                                prefetch_batches=job_configs.get('prefetch_batches', 2),
+                                inference_batch_size=job_configs.get('inference_batch_size', 32))
+    indexing_elapsed = time.perf_counter() - started_at
+    image_downloader.close()
+
+    app = Flask(__name__)
+    app.add_url_rule('/search', 'semantic_search', view_func=api_controller.search, methods=['GET'])
+    app.add_url_rule('/search/batch', 'batch_search', view_func=api_controller.search_batch, methods=['POST'])
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    search_url = f'http://127.0.0.1:{server.server_port}/search'
+    retrieval_types = (RetrievalType.semantic, RetrievalType.keyword, RetrievalType.hybrid)
+
+    results = {
+        'commit': git_commit(),
+        'parameters': vars(args),
+        'indexing': {'products': len(products),
+                     'images': len(products) * args.images_per_product,
+                     'seconds': indexing_elapsed,
+                     'images_per_second': len(products) * args.images_per_product / indexing_elapsed,
+                     'indexed_points': qdrant_manager.client.count(qdrant_manager.collection_name).count},
+        'search': {retrieval_type.name: benchmark_search(search_url, retrieval_type, args.requests, args.concurrency)
+                   for retrieval_type in retrieval_types},
+        'batch_search': {retrieval_type.name: benchmark_batch_search(f'{search_url}/batch', retrieval_type,
+                                                                     args.requests, args.concurrency, args.batch_size)
+                         for retrieval_type in retrieval_types},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    server.shutdown()
+    image_server.shutdown()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
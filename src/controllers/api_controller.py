@@ -1,105 +1,504 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
+from contextvars import copy_context
+from functools import partial
+from threading import Lock
 from typing import List, Optional, Dict
 
 from pydantic import ValidationError
 
 from controllers.qdrant_manager import QdrantManager
-from flask import request, jsonify
+from flask import Response, request, jsonify, make_response
+from loguru import logger
 
-from models.product import Product
-from models.query import Query, RetrievalType
+from models.query import Query, RetrievalType, SearchOptions
+from utils.inference_scheduler import TextEncodingScheduler
+from utils.json_response import json_response
+from utils.lru_cache import LRUCache
+from utils.metrics import Histogram, MetricsRegistry, request_timings, server_timing_header, timed
+from utils.result_cache import ResultCache
+from utils.rank_fusion import reciprocal_rank_fusion, weighted_score_fusion, percent_fusion
 
 
 class ApiController:
+    # names the legs missing from a degraded hybrid search page
+    degraded_header = 'X-Search-Degraded'
 
     def __init__(self,
                  qdrant_configs,
-                 hybrid_search_configs: Optional[Dict] = None, ):
+                 hybrid_search_configs: Optional[Dict] = None,
+                 text_cache_configs: Optional[Dict] = None,
+                 inference_scheduler_configs: Optional[Dict] = None,
+                 encoder_configs: Optional[Dict] = None,
+                 metrics_configs: Optional[Dict] = None,
+                 batch_search_configs: Optional[Dict] = None,
+                 image_search_configs: Optional[Dict] = None,
+                 result_cache_configs: Optional[Dict] = None, ):
         text_index_configs = qdrant_configs.get('text_index_configs')
         if text_index_configs:
             text_index_name = text_index_configs.get('field_name')
 
-        self.hybrid_search_configs = hybrid_search_configs
+        self.hybrid_search_configs = hybrid_search_configs or {}
         self.qdrant_manager = QdrantManager.get_qdrant_manager(url=qdrant_configs['db_url'],
                                                                api_key=qdrant_configs['db_api_key'],
                                                                collection_name=qdrant_configs['product_collection'],
-                                                               text_index_name=text_index_name)
+                                                               text_index_name=text_index_name,
+                                                               encoder_configs=encoder_configs,
+                                                               vector_store=qdrant_configs.get('vector_store', 'qdrant'),
+                                                               local_store_configs=qdrant_configs.get(
+                                                                   'local_store_configs'),
+                                                               collection_configs=qdrant_configs.get(
+                                                                   'collection_configs'),
+                                                               transport_configs=qdrant_configs.get(
+                                                                   'transport_configs'),
+                                                               health_check_interval=qdrant_configs.get(
+                                                                   'health_check_interval_seconds', 10),
+                                                               keyword_index_configs=qdrant_configs.get(
+                                                                   'keyword_index_configs'),
+                                                               text_index_configs=text_index_configs)
+
+        if text_cache_configs and text_cache_configs.get('enabled', False):
+            self.qdrant_manager.clip_encoder.text_cache = LRUCache(max_size=text_cache_configs.get('max_size', 10000),
+                                                                   ttl=text_cache_configs.get('ttl_seconds'))
+
+        self.result_cache = None
+        if result_cache_configs and result_cache_configs.get('enabled', False):
+            self.result_cache = ResultCache.from_configs(result_cache_configs)
+            # products added through this process invalidate the cached pages right away
+            self.qdrant_manager.catalog_version = self.result_cache.catalog_version
+        # catalog version the keyword index was last refreshed at, see `__refresh_keyword_index`
+        self.keyword_index_version = None
+        self.keyword_index_lock = Lock()
+
+        self.text_encoding_scheduler = None
+        if inference_scheduler_configs and inference_scheduler_configs.get('enabled', False):
+            self.text_encoding_scheduler = TextEncodingScheduler(
+                self.qdrant_manager.clip_encoder,
+                max_batch_size=inference_scheduler_configs.get('max_batch_size', 16),
+                max_wait_ms=inference_scheduler_configs.get('max_wait_ms', 5))
+            self.qdrant_manager.text_encoder = self.text_encoding_scheduler
+
+        # the semantic and keyword legs of hybrid search run concurrently on this pool
+        self.search_executor = ThreadPoolExecutor(max_workers=self.hybrid_search_configs.get('max_workers', 8),
+                                                  thread_name_prefix='hybrid-search')
+        self.leg_timeout = self.hybrid_search_configs.get('leg_timeout_ms', 1000) / 1000
+        self.max_batch_queries = (batch_search_configs or {}).get('max_queries', 64)
+        image_search_configs = image_search_configs or {}
+        self.max_image_bytes = int(image_search_configs.get('max_upload_mb', 10) * 1024 * 1024)
+        self.draft_decoding = image_search_configs.get('draft_decoding', True)
+        self.leg_timings = {leg: Histogram(buckets=[5, 10, 25, 50, 100, 250, 500, 1000, 2500])
+                            for leg in ('semantic', 'keyword')}
+        self.leg_failures = {leg: 0 for leg in ('semantic', 'keyword')}
+
+        # clients send `X-Debug-Timings` to get the stage timings of their request in `Server-Timing`
+        self.debug_timings = (metrics_configs or {}).get('debug_header', False)
+        self.metrics_registry = MetricsRegistry.get_registry()
+        self.__register_metrics()
+
+    def __register_metrics(self):
+        registry = self.metrics_registry
+        for leg, timings in self.leg_timings.items():
+            registry.register('hybrid_search_leg_milliseconds', 'Duration of the legs of client-side hybrid search',
+                              'histogram', timings, leg=leg)
+            registry.register('hybrid_search_leg_failures_total', 'Failed or timed out legs of hybrid search',
+                              'counter', lambda leg=leg: self.leg_failures[leg], leg=leg)
+
+        text_cache = self.qdrant_manager.clip_encoder.text_cache
+        if text_cache is not None:
+            registry.register('text_embedding_cache_hits_total', 'Text embedding cache hits',
+                              'counter', lambda: text_cache.hits)
+            registry.register('text_embedding_cache_misses_total', 'Text embedding cache misses',
+                              'counter', lambda: text_cache.misses)
+            registry.register('text_embedding_cache_size', 'Entries in the text embedding cache',
+                              'gauge', lambda: text_cache.stats()['size'])
+
+        if self.result_cache is not None:
+            result_cache = self.result_cache
+            registry.register('result_cache_hits_total', 'Search result pages served from the cache',
+                              'counter', lambda: result_cache.hits)
+            registry.register('result_cache_misses_total', 'Search result pages missing from the cache',
+                              'counter', lambda: result_cache.misses)
+            registry.register('result_cache_hit_ratio', 'Share of searches served from the result cache',
+                              'gauge', lambda: result_cache.stats()['hit_rate'])
+
+        keyword_index = self.qdrant_manager.keyword_index
+        if keyword_index is not None:
+            registry.register('keyword_index_documents', 'Products in the BM25 keyword index',
+                              'gauge', lambda: len(keyword_index))
+
+        if self.text_encoding_scheduler is not None:
+            registry.register('text_encoding_batch_size', 'Texts per batched forward pass',
+                              'histogram', self.text_encoding_scheduler.batch_sizes)
+            registry.register('text_encoding_queue_depth', 'Queued texts when a batch is collected',
+                              'histogram', self.text_encoding_scheduler.queue_depths)
 
     def is_ready(self):
-        self.qdrant_manager._ensure_collection()
-        return jsonify(True), 200
+        ready = self.qdrant_manager.is_healthy()
+        return jsonify(ready), 200 if ready else 503
 
     def index(self):
         return 'Hi!'
 
+    def stats(self):
+        stats = {}
+        text_cache = self.qdrant_manager.clip_encoder.text_cache
+        if text_cache is not None:
+            stats['text_embedding_cache'] = text_cache.stats()
+        if self.result_cache is not None:
+            stats['result_cache'] = self.result_cache.stats()
+        if self.text_encoding_scheduler is not None:
+            stats['text_encoding_scheduler'] = self.text_encoding_scheduler.stats()
+        stats['hybrid_search_legs'] = {leg: {'timings_ms': timings.snapshot(), 'failures': self.leg_failures[leg]}
+                                       for leg, timings in self.leg_timings.items()}
+        return jsonify(stats), 200
+
+    def metrics(self):
+        return Response(self.metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
     def search(self):
+        return self.__timed_response(self.__search)
+
+    def search_batch(self):
+        return self.__timed_response(self.__search_batch)
+
+    def similar(self, product_id: int):
+        return self.__timed_response(partial(self.__similar, product_id))
+
+    def search_image(self):
+        return self.__timed_response(self.__search_image)
+
+    def __timed_response(self, handler):
+        with request_timings() as timings:
+            with timed('total'):
+                response = make_response(handler())
+
+        if self.debug_timings and request.headers.get('X-Debug-Timings'):
+            response.headers['Server-Timing'] = server_timing_header(timings)
+        return response
+
+    def __search(self):
 
         try:
             request_args = request.args.copy()
             query = request_args.pop('query', None)
             retrieval_type = request_args.pop('retrieval_type', RetrievalType.hybrid)
             size = request_args.pop('size', 5)
+            offset = request_args.pop('offset', 0)
+            hnsw_ef = request_args.pop('hnsw_ef', None)
+            oversampling = request_args.pop('oversampling', None)
             filters = request_args.to_dict()
-            query = Query(query=query,
-                          retrieval_type=retrieval_type,
-                          size=size,
-                          filters=filters)
+            with timed('parse'):
+                query = Query(query=query,
+                              retrieval_type=retrieval_type,
+                              size=size,
+                              offset=offset,
+                              hnsw_ef=hnsw_ef,
+                              oversampling=oversampling,
+                              filters=filters)
 
         except ValidationError as e:
             return jsonify({'errors': str(e.errors())}), 400
 
+        if self.result_cache is None:
+            return self.__dispatch(query)
+
+        with timed('result_cache'):
+            cache_key = query.cache_key()
+            # read before searching, a page computed while the catalog changes is not cached
+            catalog_version = self.result_cache.version()
+            page = self.result_cache.get(cache_key)
+        if page is not None:
+            return Response(page, mimetype='application/json')
+
+        self.__refresh_keyword_index(catalog_version)
+
+        response = self.__dispatch(query)
+        # a page missing the results of a failed or timed out leg is served but not cached
+        if (isinstance(response, Response) and response.status_code == 200
+                and self.degraded_header not in response.headers):
+            self.result_cache.put(cache_key, response.get_data(), catalog_version)
+        return response
+
+    def __refresh_keyword_index(self, catalog_version: str):
+        """
+        The indexing job saves the keyword index before changing the catalog version, so a page cached
+        under the new version must be ranked by the index saved last rather than the one loaded.
+        """
+        keyword_index = self.qdrant_manager.keyword_index
+        if keyword_index is None or catalog_version == self.keyword_index_version:
+            return
+        # searches at the new version wait until the index is reloaded
+        with self.keyword_index_lock:
+            if catalog_version != self.keyword_index_version:
+                keyword_index.refresh()
+                self.keyword_index_version = catalog_version
+
+    def __dispatch(self, query: Query):
         if query.retrieval_type == RetrievalType.semantic:
             return self.__semantic_search(query)
         elif query.retrieval_type == RetrievalType.keyword:
             return self.__keyword_search(query)
         elif query.retrieval_type == RetrievalType.hybrid:
-            semantic_results_percent = self.hybrid_search_configs.get('semantic_results_percent', 50)
-            return self.__hybrid_search(query, semantic_results_percent)
+            return self.__hybrid_search(query)
         else:
             return jsonify({'description': 'Unsupported query type'}), 501
 
+    @staticmethod
+    def __search_options(request_args) -> SearchOptions:
+        request_args = request_args.copy()
+        return SearchOptions(size=request_args.pop('size', 5),
+                             hnsw_ef=request_args.pop('hnsw_ef', None),
+                             oversampling=request_args.pop('oversampling', None),
+                             filters=request_args.to_dict())
+
+    def __similar(self, product_id: int):
+        try:
+            with timed('parse'):
+                options = self.__search_options(request.args)
+        except ValidationError as e:
+            return jsonify({'errors': str(e.errors())}), 400
+
+        results = self.qdrant_manager.search_similar_products(product_id=product_id,
+                                                              top_k=options.size,
+                                                              query_filter=options.filters,
+                                                              hnsw_ef=options.hnsw_ef,
+                                                              oversampling=options.oversampling)
+        if results is None:
+            return jsonify({'description': 'Product not found'}), 404
+        return self.__results_response(results)
+
+    def __search_image(self):
+        if not self.qdrant_manager.clip_encoder.has_image_tower:
+            return jsonify({'description': 'Image search needs the image tower, set encoder_configs.serving_mode '
+                                           'to full'}), 501
+        if request.content_length is not None and request.content_length > self.max_image_bytes:
+            return jsonify({'errors': f'images are limited to {self.max_image_bytes} bytes'}), 413
+
+        try:
+            with timed('parse'):
+                options = self.__search_options(request.values)
+        except ValidationError as e:
+            return jsonify({'errors': str(e.errors())}), 400
+
+        # a multipart `image` file or the raw request body
+        image_file = request.files.get('image')
+        content = image_file.read() if image_file is not None else request.get_data()
+        if not content:
+            return jsonify({'errors': 'expected an image'}), 400
+
+        # PIL is only loaded by the processes serving image searches
+        from utils.image_preprocessing import decode_image
+
+        image_preprocessor = self.qdrant_manager.clip_encoder.image_preprocessor
+        draft_size = image_preprocessor.size if self.draft_decoding and image_preprocessor is not None else None
+        try:
+            with timed('decode'):
+                image = decode_image(content, draft_size)
+        except Exception as e:
+            return jsonify({'errors': f'could not decode the image: {e}'}), 400
+
+        results = self.qdrant_manager.search_products_by_image([image],
+                                                               top_k=options.size,
+                                                               query_filter=options.filters,
+                                                               hnsw_ef=options.hnsw_ef,
+                                                               oversampling=options.oversampling)
+        return self.__results_response(results)
+
     def __semantic_search(self, query: Query):
         results = self.qdrant_manager.search_products_by_text(text=query.query,
-                                                              top_k=query.size,
-                                                              query_filter=query.filters)
-        return jsonify([r['product'].to_response_obj() for r in results]), 200
+                                                              top_k=query.offset + query.size,
+                                                              query_filter=query.filters,
+                                                              hnsw_ef=query.hnsw_ef,
+                                                              oversampling=query.oversampling)
+        return self.__results_response(results[query.offset:])
 
     def __keyword_search(self, query: Query):
         results = self.qdrant_manager.search_products_by_keyword(text=query.query,
                                                                  top_k=query.size,
-                                                                 query_filter=query.filters)
-        return jsonify([r['product'].to_response_obj() for r in results]), 200
+                                                                 query_filter=query.filters,
+                                                                 offset=query.offset)
+        return self.__results_response(results)
+
+    def __hybrid_search(self, query: Query):
+        candidate_depth = self.__candidate_depth(query)
+
+        if self.__server_side_fusion:
+            try:
+                results = self.qdrant_manager.search_products_hybrid(text=query.query,
+                                                                     top_k=query.offset + query.size,
+                                                                     query_filter=query.filters,
+                                                                     candidate_depth=candidate_depth,
+                                                                     hnsw_ef=query.hnsw_ef,
+                                                                     oversampling=query.oversampling)
+                return self.__results_response(results[query.offset:])
+            except Exception as e:
+                logger.error('server-side hybrid search failed, fusing the results client-side')
+                logger.error(e)
+
+        deadline = time.monotonic() + self.leg_timeout
+        # the legs run in copies of the request's context, so their stages show up in its timings
+        semantic_leg = self.search_executor.submit(copy_context().run, self.__timed_leg, 'semantic',
+                                                   self.qdrant_manager.search_products_by_text,
+                                                   text=query.query,
+                                                   top_k=candidate_depth,
+                                                   query_filter=query.filters,
+                                                   hnsw_ef=query.hnsw_ef,
+                                                   oversampling=query.oversampling)
+        keyword_leg = self.search_executor.submit(copy_context().run, self.__timed_leg, 'keyword',
+                                                  self.qdrant_manager.search_products_by_keyword,
+                                                  text=query.query,
+                                                  top_k=candidate_depth,
+                                                  query_filter=query.filters)
+
+        # a slow or failing leg degrades to the results of the other one
+        semantic_results = self.__leg_results('semantic', semantic_leg, deadline)
+        keyword_results = self.__leg_results('keyword', keyword_leg, deadline)
+        if semantic_results is None and keyword_results is None:
+            return jsonify({'description': 'Search backends are unavailable'}), 503
+
+        response = self.__results_response(self.__fuse(semantic_results or [], keyword_results or [],
+                                                       query.offset + query.size)[query.offset:])
+        failed_legs = [leg for leg, results in (('semantic', semantic_results), ('keyword', keyword_results))
+                       if results is None]
+        if failed_legs:
+            response.headers[self.degraded_header] = ','.join(failed_legs)
+        return response
+
+    def __fuse(self, semantic_results: List[Dict], keyword_results: List[Dict], size: int) -> List[Dict]:
+        fusion = self.hybrid_search_configs.get('fusion', 'rrf')
+        semantic_weight = self.hybrid_search_configs.get('semantic_weight', 0.5)
+        with timed('fusion'):
+            if fusion == 'percent':
+                semantic_results_percent = self.hybrid_search_configs.get('semantic_results_percent', 50)
+                return percent_fusion(semantic_results, keyword_results, size, semantic_results_percent)
+            elif fusion == 'weighted':
+                return weighted_score_fusion([semantic_results, keyword_results], size,
+                                             weights=[semantic_weight, 1 - semantic_weight])
+            else:
+                return reciprocal_rank_fusion([semantic_results, keyword_results], size,
+                                              k=self.hybrid_search_configs.get('rrf_k', 60),
+                                              weights=[semantic_weight, 1 - semantic_weight])
 
-    def __hybrid_search(self, query: Query, semantic_result_percentage: int = 50):
-        semantic_results = self.qdrant_manager.search_products_by_text(text=query.query,
-                                                                       top_k=query.size,
-                                                                       query_filter=query.filters)
-        semantic_results = [res['product'] for res in semantic_results]
+    def __search_batch(self):
+        queries = request.get_json(silent=True)
+        if isinstance(queries, dict):
+            queries = queries.get('queries')
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'errors': 'expected a non-empty list of queries'}), 400
+        if len(queries) > self.max_batch_queries:
+            return jsonify({'errors': f'at most {self.max_batch_queries} queries are allowed in a batch'}), 400
 
-        keyword_results = self.qdrant_manager.search_products_by_keyword(text=query.query,
-                                                                         top_k=query.size,
-                                                                         query_filter=query.filters)
-        keyword_results = [res['product'] for res in keyword_results]
+        try:
+            with timed('parse'):
+                queries = [Query.model_validate(query) for query in queries]
+        except ValidationError as e:
+            return jsonify({'errors': str(e.errors())}), 400
+
+        results: List[Optional[List[Dict]]] = [None] * len(queries)
+        hybrid = [index for index, query in enumerate(queries) if query.retrieval_type == RetrievalType.hybrid]
+
+        # all query texts go through a single forward pass
+        encoded = [index for index, query in enumerate(queries) if query.retrieval_type != RetrievalType.keyword]
+        text_embeddings = {}
+        if encoded:
+            text_embeddings = dict(zip(encoded, self.qdrant_manager.encode_texts([queries[index].query
+                                                                                 for index in encoded])))
+
+        if hybrid and self.__server_side_fusion:
+            try:
+                hybrid_results = self.qdrant_manager.search_products_hybrid_batch([
+                    dict(self.__search_kwargs(queries[index]),
+                         text=queries[index].query,
+                         vector=text_embeddings[index],
+                         top_k=queries[index].offset + queries[index].size,
+                         candidate_depth=self.__candidate_depth(queries[index]))
+                    for index in hybrid])
+                for index, hits in zip(hybrid, hybrid_results):
+                    results[index] = hits
+                hybrid = []
+            except Exception as e:
+                logger.error('server-side hybrid search failed, fusing the results client-side')
+                logger.error(e)
+
+        deadline = time.monotonic() + self.leg_timeout
+        keyword_legs = {}
+        for index, query in enumerate(queries):
+            if query.retrieval_type == RetrievalType.keyword:
+                keyword_legs[index] = self.search_executor.submit(copy_context().run,
+                                                                  self.qdrant_manager.search_products_by_keyword,
+                                                                  text=query.query,
+                                                                  top_k=query.size,
+                                                                  query_filter=query.filters,
+                                                                  offset=query.offset)
+            elif index in hybrid:
+                keyword_legs[index] = self.search_executor.submit(copy_context().run, self.__timed_leg, 'keyword',
+                                                                  self.qdrant_manager.search_products_by_keyword,
+                                                                  text=query.query,
+                                                                  top_k=self.__candidate_depth(query),
+                                                                  query_filter=query.filters)
+
+        # the semantic searches and the semantic legs of client-side hybrid searches go in a single request
+        vector_searches = [index for index in encoded if results[index] is None]
+        if vector_searches:
+            vector_results = self.qdrant_manager.search_products_by_vectors([
+                dict(self.__search_kwargs(queries[index]),
+                     vector=text_embeddings[index],
+                     top_k=self.__candidate_depth(queries[index]) if index in hybrid
+                     else queries[index].offset + queries[index].size)
+                for index in vector_searches])
+            for index, hits in zip(vector_searches, vector_results):
+                results[index] = hits
 
-        # combine the results
-        results = semantic_results[:int(query.size * semantic_result_percentage / 100)]
+        for index, keyword_leg in keyword_legs.items():
+            if index in hybrid:
+                keyword_results = self.__leg_results('keyword', keyword_leg, deadline) or []
+                results[index] = self.__fuse(results[index], keyword_results,
+                                             queries[index].offset + queries[index].size)
+            else:
+                results[index] = keyword_leg.result()
 
-        for res in keyword_results:
-            if len(results) >= query.size:
-                break
-            if self.__not_duplicated(res, results):
-                results.append(res)
+        # keyword searches are already paged by the index
+        for index, query in enumerate(queries):
+            if query.retrieval_type != RetrievalType.keyword:
+                results[index] = results[index][query.offset:]
 
-        for res in semantic_results[int(query.size * semantic_result_percentage / 100):]:
-            if len(results) >= query.size:
-                break
-            if self.__not_duplicated(res, results):
-                results.append(res)
+        with timed('serialize'):
+            return json_response([[r['product'].to_response_obj() for r in hits] for hits in results])
 
-        return jsonify([r.to_response_obj() for r in results]), 200
+    @property
+    def __server_side_fusion(self) -> bool:
+        return (self.hybrid_search_configs.get('fusion', 'rrf') == 'rrf'
+                and self.hybrid_search_configs.get('server_side_fusion', True)
+                and self.qdrant_manager.supports_server_side_fusion)
+
+    def __candidate_depth(self, query: Query) -> int:
+        if self.hybrid_search_configs.get('fusion', 'rrf') == 'percent':
+            return query.offset + query.size
+        return max(self.hybrid_search_configs.get('candidate_depth', 50), query.offset + query.size)
+
+    @staticmethod
+    def __search_kwargs(query: Query) -> Dict:
+        return {'query_filter': query.filters, 'hnsw_ef': query.hnsw_ef, 'oversampling': query.oversampling}
 
     @staticmethod
-    def __not_duplicated(product: Product, product_list: List[Product]):
-        for product_item in product_list:
-            if product_item.uuid == product.uuid:
-                return False
-        return True
+    def __results_response(results: List[Dict]):
+        with timed('serialize'):
+            return json_response([r['product'].to_response_obj() for r in results])
+
+    def __timed_leg(self, leg: str, search_fn, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return search_fn(**kwargs)
+        finally:
+            self.leg_timings[leg].observe((time.perf_counter() - started_at) * 1000)
+
+    def __leg_results(self, leg: str, future: Future, deadline: float) -> Optional[List[Dict]]:
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            logger.warning(f'{leg} leg of hybrid search timed out')
+        except Exception as e:
+            logger.error(f'{leg} leg of hybrid search failed')
+            logger.error(e)
+        self.leg_failures[leg] += 1
+        return None
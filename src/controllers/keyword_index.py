@@ -0,0 +1,481 @@
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+from qdrant_client import QdrantClient, models
+
+from controllers.vector_store import PayloadFilter, ValueColumn
+from models.product import ProductHit
+
+
+class Tokenizer:
+    """Tokenization of Qdrant's full text index, so the BM25 index sees the tokens `text_index_configs` index"""
+
+    def __init__(self,
+                 tokenizer: str = 'word',
+                 min_token_len: Optional[int] = None,
+                 max_token_len: Optional[int] = None,
+                 lowercase: bool = True):
+        """
+        Args:
+            tokenizer (str): word (and multilingual) split on non-word characters, whitespace on spaces and
+                prefix indexes every prefix of the words so query tokens match as prefixes
+            min_token_len (int): Shorter tokens are dropped
+            max_token_len (int): Longer tokens are dropped
+            lowercase (bool): Whether tokens are lower-cased
+        """
+        if tokenizer not in ('word', 'multilingual', 'whitespace', 'prefix'):
+            raise ValueError(f'Unsupported tokenizer {tokenizer}')
+        self.tokenizer = tokenizer
+        self.min_token_len = min_token_len or 1
+        self.max_token_len = max_token_len
+        self.lowercase = lowercase
+
+    @classmethod
+    def from_configs(cls, text_index_configs: Optional[Dict]) -> 'Tokenizer':
+        text_index_configs = text_index_configs or {}
+        return cls(tokenizer=text_index_configs.get('tokenizer', 'word'),
+                   min_token_len=text_index_configs.get('min_token_len'),
+                   max_token_len=text_index_configs.get('max_token_len'),
+                   lowercase=text_index_configs.get('lowercase', True))
+
+    def __call__(self, text: str, query: bool = False) -> List[str]:
+        if self.lowercase:
+            text = text.lower()
+        words = text.split() if self.tokenizer == 'whitespace' else re.findall(r'\w+', text)
+        tokens = [word for word in words if len(word) >= self.min_token_len
+                  and (self.max_token_len is None or len(word) <= self.max_token_len)]
+        if self.tokenizer == 'prefix' and not query:
+            return [word[:end] for word in tokens for end in range(self.min_token_len, len(word) + 1)]
+        return tokens
+
+
+class _Segment:
+    """
+    Immutable saved index, memory-mapped: the postings in CSR layout (the rows of term `t` are
+    `rows[indptr[t]:indptr[t + 1]]`), the document lengths, the id and hit payload of every row as
+    JSON lines decoded only for the returned hits, and a `ValueColumn` per filter field.
+    """
+    arrays = ('indptr', 'rows', 'tfs', 'lengths', 'offsets')
+    terms_file = 'terms.json'
+    points_file = 'points.jsonl'
+    filters_file = 'filters.json'
+
+    def __init__(self, terms: List[str], indptr: np.ndarray, rows: np.ndarray, tfs: np.ndarray,
+                 lengths: np.ndarray, offsets: np.ndarray, points, columns: Dict[str, ValueColumn]):
+        self.terms = {term: term_id for term_id, term in enumerate(terms)}
+        self.indptr = indptr
+        self.rows = rows
+        self.tfs = tfs
+        self.lengths = lengths
+        self.offsets = offsets
+        self.points = points
+        self.columns = columns
+
+    @classmethod
+    def empty(cls) -> '_Segment':
+        return cls([], np.zeros(1, np.int64), np.zeros(0, np.int32), np.zeros(0, np.uint16),
+                   np.zeros(0, np.float32), np.zeros(1, np.int64), b'', {})
+
+    @classmethod
+    def load(cls, path: str) -> '_Segment':
+        with open(os.path.join(path, cls.terms_file), 'r') as terms_file:
+            terms = json.load(terms_file)
+        with open(os.path.join(path, cls.filters_file), 'r') as filters_file:
+            filter_fields = json.load(filters_file)
+        # the segment stays on disk, pages are read as terms, filters and hits are looked up
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in cls.arrays}
+        points = b''
+        with open(os.path.join(path, cls.points_file), 'rb') as points_file:
+            if os.fstat(points_file.fileno()).st_size:
+                points = mmap.mmap(points_file.fileno(), 0, access=mmap.ACCESS_READ)
+        columns = {field: ValueColumn.load(os.path.join(path, f'filter-{index}'))
+                   for index, field in enumerate(filter_fields)}
+        return cls(terms, points=points, columns=columns, **arrays)
+
+    def save(self, path: str):
+        os.makedirs(path)
+        with open(os.path.join(path, self.terms_file), 'w') as terms_file:
+            json.dump(sorted(self.terms, key=self.terms.get), terms_file)
+        for name in self.arrays:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, self.points_file), 'wb') as points_file:
+            points_file.write(self.points)
+        with open(os.path.join(path, self.filters_file), 'w') as filters_file:
+            json.dump(list(self.columns), filters_file)
+        for index, column in enumerate(self.columns.values()):
+            column.save(os.path.join(path, f'filter-{index}'))
+
+    @property
+    def size(self) -> int:
+        return len(self.lengths)
+
+    def point_line(self, row: int) -> bytes:
+        return self.points[self.offsets[row]:self.offsets[row + 1]]
+
+    def point(self, row: int) -> Tuple:
+        point = json.loads(self.point_line(row))
+        return point['id'], point['payload']
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        term_id = self.terms.get(term)
+        if term_id is None:
+            return np.zeros(0, np.int32), np.zeros(0, np.uint16)
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.rows[start:end], self.tfs[start:end]
+
+
+class KeywordIndex:
+    """
+    In-process BM25 index of a payload text field, searched instead of Qdrant's unranked full text match.
+
+    The saved index is a `_Segment` memory-mapped from `path`; only the fields of the hits and the
+    `filter_fields` of the payloads are kept. Upserts and deletions go to an in-memory delta over the
+    segment (deleted and replaced rows are tombstoned) and `save` merges both into a new segment
+    without re-tokenizing the catalog. The segment in use is named by the `CURRENT` file, which
+    serving processes poll every `reload_interval` seconds to pick up the segments saved by the
+    indexing job. Saving keeps the previous segment for the processes still reading it.
+    """
+    current_file = 'CURRENT'
+
+    def __init__(self,
+                 path: str,
+                 field: str,
+                 tokenizer: Tokenizer,
+                 k1: float = 1.2,
+                 b: float = 0.75,
+                 match: str = 'all',
+                 filter_fields: Sequence[str] = (),
+                 reload_interval: float = 10):
+        """
+        Args:
+            path (str): Directory of the saved segments
+            field (str): Payload field indexed
+            tokenizer (Tokenizer): Tokenizer of the field and of the queries
+            k1 (float): BM25 term frequency saturation
+            b (float): BM25 document length normalization
+            match (str): all to match only documents with every query token like Qdrant's text match, any for all
+            filter_fields (Sequence[str]): Payload fields searches can filter on
+            reload_interval (float): Seconds between checks for a segment saved by another process
+        """
+        self.path = path
+        self.field = field
+        self.tokenizer = tokenizer
+        self.k1 = k1
+        self.b = b
+        self.match = match
+        self.filter_fields = list(filter_fields)
+        self.reload_interval = reload_interval
+        self._lock = Lock()
+        self._checked_at = time.monotonic()
+        self._load(self._current_segment_name())
+
+    @classmethod
+    def from_configs(cls, keyword_index_configs: Dict, text_index_configs: Optional[Dict]) -> 'KeywordIndex':
+        return cls(path=keyword_index_configs['path'],
+                   field=(text_index_configs or {}).get('field_name', 'name'),
+                   tokenizer=Tokenizer.from_configs(text_index_configs),
+                   k1=keyword_index_configs.get('k1', 1.2),
+                   b=keyword_index_configs.get('b', 0.75),
+                   match=keyword_index_configs.get('match', 'all'),
+                   filter_fields=keyword_index_configs.get('filter_fields', ()),
+                   reload_interval=keyword_index_configs.get('reload_interval_seconds', 10))
+
+    def _current_segment_name(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, self.current_file), 'r') as current:
+                return current.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _load(self, segment_name: Optional[str]):
+        segment = _Segment.load(os.path.join(self.path, segment_name)) if segment_name else _Segment.empty()
+        with self._lock:
+            self._segment_name = segment_name
+            self._segment = segment
+            # an empty segment matches no value of any field
+            columns = segment.columns if segment.size else {field: ValueColumn.from_values([])
+                                                             for field in self.filter_fields}
+            self._segment_filter = PayloadFilter(segment.size, columns=columns)
+            self._segment_deleted = np.zeros(segment.size, dtype=bool)
+            # row of every id, built by the first write (only the indexing job writes)
+            self._rows: Optional[Dict[str, int]] = None
+            self._clear_delta()
+        if segment_name:
+            logger.info(f'loaded {segment.size} documents from the keyword index segment {segment_name}')
+
+    def _clear_delta(self):
+        self._delta_ids, self._delta_payloads, self._delta_lengths = [], [], []
+        self._delta_deleted: List[bool] = []
+        self._delta_postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._delta_filter: Optional[PayloadFilter] = None
+
+    def refresh(self):
+        """Load the segment saved last right away, e.g. once the catalog version changed"""
+        self._maybe_reload(force=True)
+
+    def _maybe_reload(self, force: bool = False):
+        if not force and time.monotonic() - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = time.monotonic()
+        segment_name = self._segment_name
+        try:
+            segment_name = self._current_segment_name()
+            if segment_name == self._segment_name:
+                return
+            if self._delta_ids:
+                logger.warning(f'not loading keyword index segment {segment_name}, unsaved documents would be lost')
+                return
+            self._load(segment_name)
+        except Exception as e:
+            # e.g. removed by the indexing job while loading, the next check loads the one saved since
+            logger.error(f'failed to load the keyword index segment {segment_name}, '
+                         f'searching {self._segment_name} until the next check')
+            logger.error(e)
+
+    def __len__(self):
+        return int(self._segment.size - self._segment_deleted.sum()) + self._delta_deleted.count(False)
+
+    def supports_filter(self, query_filter: models.Filter | None) -> bool:
+        """Whether `query_filter` only matches values of the filter fields"""
+        if query_filter is None:
+            return True
+        for condition in (*(query_filter.must or []), *(query_filter.should or []), *(query_filter.must_not or [])):
+            if isinstance(condition, models.Filter):
+                if not self.supports_filter(condition):
+                    return False
+            elif not (isinstance(condition, models.FieldCondition)
+                      and isinstance(condition.match, (models.MatchValue, models.MatchAny))
+                      and condition.key in self.filter_fields
+                      and (self._segment.size == 0 or condition.key in self._segment.columns)):
+                return False
+        return True
+
+    def _row_ids(self) -> Dict[str, int]:
+        if self._rows is None:
+            self._rows = {}
+            for row in np.flatnonzero(~self._segment_deleted):
+                self._rows[str(self._segment.point(int(row))[0])] = int(row)
+            segment_size = self._segment.size
+            for delta_row, (point_id, deleted) in enumerate(zip(self._delta_ids, self._delta_deleted)):
+                if not deleted:
+                    self._rows[str(point_id)] = segment_size + delta_row
+        return self._rows
+
+    def _delete_row(self, row: int):
+        segment_size = self._segment.size
+        if row < segment_size:
+            self._segment_deleted[row] = True
+        else:
+            self._delta_deleted[row - segment_size] = True
+
+    def _stored_payload(self, payload: Dict) -> Dict:
+        return {key: payload[key] for key in (*ProductHit.payload_fields, *self.filter_fields) if key in payload}
+
+    def upsert(self, points: Iterable[Tuple]):
+        """Index `(id, payload)` pairs, replacing the documents already indexed under the same ids"""
+        with self._lock:
+            rows = self._row_ids()
+            for point_id, payload in points:
+                row = rows.get(str(point_id))
+                if row is not None:
+                    self._delete_row(row)
+
+                row = self._segment.size + len(self._delta_ids)
+                tokens = self.tokenizer(str(payload.get(self.field) or ''))
+                for term, tf in Counter(tokens).items():
+                    self._delta_postings.setdefault(term, []).append((row, tf))
+                self._delta_ids.append(point_id)
+                self._delta_payloads.append(self._stored_payload(payload))
+                self._delta_lengths.append(len(tokens))
+                self._delta_deleted.append(False)
+                rows[str(point_id)] = row
+            self._delta_filter = None
+
+    def delete(self, ids: Iterable):
+        with self._lock:
+            rows = self._row_ids()
+            for point_id in ids:
+                row = rows.pop(str(point_id), None)
+                if row is not None:
+                    self._delete_row(row)
+
+    def clear(self):
+        """Drop every document, e.g. before rebuilding the index from the collection"""
+        with self._lock:
+            self._segment_deleted[:] = True
+            self._rows = {}
+            self._clear_delta()
+
+    def _point(self, row: int) -> Tuple:
+        segment_size = self._segment.size
+        if row < segment_size:
+            return self._segment.point(row)
+        return self._delta_ids[row - segment_size], self._delta_payloads[row - segment_size]
+
+    def search(self,
+               text: str,
+               top_k: int = 10,
+               query_filter: models.Filter | None = None,
+               offset: int = 0) -> List[models.ScoredPoint]:
+        """
+        Documents matching the tokens of `text` and `query_filter` ranked by BM25,
+        the `top_k` of them following the first `offset`.
+        """
+        self._maybe_reload()
+        terms = list(dict.fromkeys(self.tokenizer(text, query=True)))
+        if not terms:
+            return []
+
+        with self._lock:
+            segment = self._segment
+            live = np.concatenate([~self._segment_deleted, ~np.asarray(self._delta_deleted, dtype=bool)])
+            lengths = np.concatenate([segment.lengths, np.asarray(self._delta_lengths, dtype=np.float32)])
+            postings = []
+            for term in terms:
+                rows, tfs = segment.postings(term)
+                delta = self._delta_postings.get(term)
+                if delta:
+                    delta_rows, delta_tfs = zip(*delta)
+                    rows = np.concatenate([rows, np.asarray(delta_rows, dtype=np.int32)])
+                    tfs = np.concatenate([tfs, np.asarray(delta_tfs, dtype=np.uint16)])
+                postings.append((rows, tfs))
+            filter_mask = self._filter_mask(query_filter)
+
+        num_documents = int(live.sum())
+        if num_documents == 0:
+            return []
+        average_length = float(lengths[live].mean()) or 1.0
+        scores = np.zeros(len(live), dtype=np.float32)
+        matched_terms = np.zeros(len(live), dtype=np.int32)
+        for rows, tfs in postings:
+            keep = live[rows]
+            rows, tfs = rows[keep], tfs[keep].astype(np.float32)
+            if len(rows) == 0:
+                continue
+            idf = np.log(1 + (num_documents - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / average_length)
+            # a term has at most one posting per row, so the fancy-indexed update adds up correctly
+            scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+            matched_terms[rows] += 1
+
+        candidates = matched_terms == len(terms) if self.match == 'all' else matched_terms > 0
+        if filter_mask is not None:
+            candidates &= filter_mask
+        rows = np.flatnonzero(candidates)
+        limit = offset + top_k
+        if len(rows) > limit:
+            rows = rows[np.argpartition(-scores[rows], limit - 1)[:limit]]
+        # ties keep the row order, the order of insertion
+        rows = rows[np.lexsort((rows, -scores[rows]))][offset:limit]
+
+        results = []
+        for row in rows:
+            point_id, payload = self._point(int(row))
+            results.append(models.ScoredPoint(id=point_id, version=0, score=float(scores[row]), payload=payload))
+        return results
+
+    def _filter_mask(self, query_filter: models.Filter | None) -> Optional[np.ndarray]:
+        if query_filter is None:
+            return None
+        if self._delta_filter is None:
+            self._delta_filter = PayloadFilter(len(self._delta_payloads), self._delta_ids, self._delta_payloads)
+        return np.concatenate([self._segment_filter.mask(query_filter), self._delta_filter.mask(query_filter)])
+
+    def save(self) -> bool:
+        """Merge the delta into a new segment and make it the current one, returns whether anything changed"""
+        with self._lock:
+            if not self._delta_ids and not self._segment_deleted.any() and self._segment_name is not None:
+                return False
+            segment = self._merged_segment()
+
+        segment_name = f'segment-{time.time_ns()}'
+        segment.save(os.path.join(self.path, segment_name))
+        previous_segment_name = self._current_segment_name()
+        with open(os.path.join(self.path, f'{self.current_file}.tmp'), 'w') as current:
+            current.write(segment_name)
+        os.replace(os.path.join(self.path, f'{self.current_file}.tmp'), os.path.join(self.path, self.current_file))
+
+        # serving processes may still be loading or mapping the previous segment, only older ones are removed
+        for name in os.listdir(self.path):
+            if name.startswith('segment-') and name not in (segment_name, previous_segment_name):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        self._load(segment_name)
+        logger.info(f'saved {segment.size} documents to the keyword index segment {segment_name}')
+        return True
+
+    def _merged_segment(self) -> _Segment:
+        segment = self._segment
+        segment_size = segment.size
+        live = np.concatenate([~self._segment_deleted, ~np.asarray(self._delta_deleted, dtype=bool)])
+        # new row of every old one, -1 for deleted rows
+        new_rows = np.full(len(live), -1, dtype=np.int64)
+        new_rows[live] = np.arange(int(live.sum()))
+
+        terms = sorted(set(segment.terms) | set(self._delta_postings))
+        term_ids = {term: term_id for term_id, term in enumerate(terms)}
+        segment_term_ids = np.asarray([term_ids[term] for term in sorted(segment.terms, key=segment.terms.get)],
+                                      dtype=np.int64)
+        posting_terms = [np.repeat(segment_term_ids, np.diff(segment.indptr))]
+        posting_rows = [new_rows[np.asarray(segment.rows, dtype=np.int64)]]
+        posting_tfs = [np.asarray(segment.tfs)]
+        for term, postings in self._delta_postings.items():
+            delta_rows, delta_tfs = zip(*postings)
+            posting_terms.append(np.full(len(postings), term_ids[term], dtype=np.int64))
+            posting_rows.append(new_rows[np.asarray(delta_rows, dtype=np.int64)])
+            posting_tfs.append(np.asarray(delta_tfs, dtype=np.uint16))
+
+        posting_terms, posting_rows, posting_tfs = (np.concatenate(arrays) for arrays in
+                                                    (posting_terms, posting_rows, posting_tfs))
+        keep = posting_rows >= 0
+        posting_terms, posting_rows, posting_tfs = posting_terms[keep], posting_rows[keep], posting_tfs[keep]
+        order = np.lexsort((posting_rows, posting_terms))
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_terms, minlength=len(terms)), out=indptr[1:])
+
+        # saved rows are copied as they are, only the delta is serialized
+        live_rows = np.flatnonzero(live)
+        lengths = np.concatenate([segment.lengths, np.asarray(self._delta_lengths, dtype=np.float32)])[live_rows]
+        lines, filter_values = [], {field: [] for field in self.filter_fields}
+        for row in live_rows:
+            if row < segment_size:
+                lines.append(bytes(segment.point_line(row)))
+                for field, values in filter_values.items():
+                    column = segment.columns.get(field)
+                    values.append(column.value(row) if column is not None else None)
+            else:
+                point_id, payload = self._delta_ids[row - segment_size], self._delta_payloads[row - segment_size]
+                hit_payload = {key: payload[key] for key in ProductHit.payload_fields if key in payload}
+                lines.append(json.dumps({'id': point_id, 'payload': hit_payload}, default=str).encode() + b'\n')
+                for field, values in filter_values.items():
+                    values.append(payload.get(field))
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum([len(line) for line in lines], out=offsets[1:])
+
+        return _Segment(terms, indptr, posting_rows[order].astype(np.int32), posting_tfs[order].astype(np.uint16),
+                        lengths.astype(np.float32), offsets, b''.join(lines),
+                        {field: ValueColumn.from_values(values) for field, values in filter_values.items()})
+
+    def build_from_qdrant(self, client: QdrantClient, collection_name: str, batch_size: int = 256) -> bool:
+        """Rebuild the index from the payloads of a Qdrant collection, returns whether a segment was saved"""
+        self.clear()
+        offset = None
+        while True:
+            records, offset = client.scroll(collection_name=collection_name,
+                                            limit=batch_size,
+                                            offset=offset,
+                                            with_payload=[*ProductHit.payload_fields, *self.filter_fields,
+                                                          self.field],
+                                            with_vectors=False)
+            self.upsert((record.id, record.payload) for record in records)
+            if offset is None:
+                break
+        return self.save()
@@ -1,41 +1,262 @@
-from typing import List, Dict
+import os
+import threading
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+from typing import List, Dict, Tuple, Iterable, TYPE_CHECKING
+
+import httpx
+import numpy as np
 from qdrant_client import QdrantClient, models
 from qdrant_client.http import exceptions
+from controllers.keyword_index import KeywordIndex
+from controllers.vector_store import LocalVectorStore, QdrantVectorStore
 from utils.clip_encoder import CLIPEncoder
-from models.product import Product
+from utils.embedding_cache import EmbeddingCache
+from utils.index_checkpoint import IndexCheckpoint
+from utils.metrics import count_indexed, indexer_stage, timed
+from utils.result_cache import CatalogVersion
+from utils.upload_pipeline import UploadPipeline
+from models.product import Product, ProductHit
 from loguru import logger
 
+if TYPE_CHECKING:
+    from PIL import Image
+    from utils.image_downloader import ImageDownloader
+
+
+def create_qdrant_client(url: str, api_key: str | None, transport_configs: Dict | None = None) -> QdrantClient:
+    """
+    Client with the transport of `transport_configs`: gRPC or REST, request timeout, the size of the
+    REST connection pool and keep-alive of both. `url` may also be ":memory:" for an in-process Qdrant.
+    """
+    transport_configs = transport_configs or {}
+    if url == ':memory:':
+        return QdrantClient(location=url, api_key=api_key)
+
+    keepalive_ms = int(transport_configs.get('keepalive_seconds', 30) * 1000)
+    return QdrantClient(
+        location=url,
+        api_key=api_key,
+        prefer_grpc=transport_configs.get('prefer_grpc', False),
+        grpc_port=transport_configs.get('grpc_port', 6334),
+        timeout=transport_configs.get('timeout_seconds'),
+        limits=httpx.Limits(max_connections=transport_configs.get('max_connections', 64),
+                            max_keepalive_connections=transport_configs.get('max_keepalive_connections', 16),
+                            keepalive_expiry=transport_configs.get('keepalive_seconds', 30)),
+        http2=transport_configs.get('http2', False),
+        # pings keep idle channels open through load balancers and detect dead ones
+        grpc_options={'grpc.keepalive_time_ms': keepalive_ms,
+                      'grpc.keepalive_timeout_ms': 10000,
+                      'grpc.keepalive_permit_without_calls': 1,
+                      'grpc.http2.max_pings_without_data': 0},
+    )
+
 
 class QdrantManager:
     qdrant_manager = None
 
     @staticmethod
-    def get_qdrant_manager(url, api_key, collection_name, text_index_name=None):
+    def get_qdrant_manager(url, api_key, collection_name, text_index_name=None, encoder_configs=None,
+                           vector_store='qdrant', local_store_configs=None, collection_configs=None,
+                           transport_configs=None, health_check_interval=10, keyword_index_configs=None,
+                           text_index_configs=None):
         if QdrantManager.qdrant_manager is None:
-            QdrantManager.qdrant_manager = QdrantManager(url, api_key, collection_name, text_index_name)
+            QdrantManager.qdrant_manager = QdrantManager(url, api_key, collection_name, text_index_name,
+                                                         encoder_configs, vector_store, local_store_configs,
+                                                         collection_configs, transport_configs,
+                                                         health_check_interval, keyword_index_configs,
+                                                         text_index_configs)
         return QdrantManager.qdrant_manager
 
-    def __init__(self, url: str, api_key: str, collection_name: str, text_index_name: str | None = None):
-        self.client = QdrantClient(url=url,
-                                   api_key=api_key)
+    def __init__(self,
+                 url: str,
+                 api_key: str,
+                 collection_name: str,
+                 text_index_name: str | None = None,
+                 encoder_configs: Dict | None = None,
+                 vector_store: str = 'qdrant',
+                 local_store_configs: Dict | None = None,
+                 collection_configs: Dict | None = None,
+                 transport_configs: Dict | None = None,
+                 health_check_interval: float = 10,
+                 keyword_index_configs: Dict | None = None,
+                 text_index_configs: Dict | None = None):
+        self.url = url
+        self.api_key = api_key
+        self.transport_configs = transport_configs or {}
+        # `shared`: one thread-safe client per process, `thread_local`: one client (and connection pool)
+        # per server thread; an in-process Qdrant (":memory:") is always shared
+        self.client_strategy = self.transport_configs.get('client_strategy', 'shared') if url != ':memory:' \
+            else 'shared'
+        self._client = create_qdrant_client(url, api_key, self.transport_configs)
+        self._thread_clients = threading.local()
         self.collection_name = collection_name
-        self.clip_encoder = CLIPEncoder()
+        self.clip_encoder = CLIPEncoder(**(encoder_configs or {}))
+        # anything exposing `encode_text`, e.g. a micro-batching scheduler in front of the encoder
+        self.text_encoder = self.clip_encoder
         self.text_index_name = text_index_name
+        self._supports_server_side_fusion = None
+        # changed on every write, so cached result pages of the previous catalog are never served
+        self.catalog_version: CatalogVersion | None = None
+        # whether this process wrote to the collection, a run that changed nothing keeps the cached pages
+        self.catalog_modified = False
+
+        collection_configs = collection_configs or {}
+        self.collection_profile = collection_configs.get('profiles', {}).get(collection_configs.get('profile'), {})
+        self.filter_index_fields = collection_configs.get('filter_index_fields', [])
+        self.search_configs = collection_configs.get('search_params', {})
+
+        # searches run against Qdrant or an in-process snapshot of the collection
+        self.uses_local_store = vector_store == 'local'
+        if self.uses_local_store:
+            self.vector_store = LocalVectorStore(**(local_store_configs or {}))
+            self._supports_server_side_fusion = False
+        else:
+            self.vector_store = QdrantVectorStore(lambda: self.client, collection_name)
+
+        # keyword searches are ranked by a local BM25 index instead of Qdrant's unranked text match
+        self.keyword_index = None
+        if keyword_index_configs and keyword_index_configs.get('enabled', False):
+            self.keyword_index = KeywordIndex.from_configs(keyword_index_configs, text_index_configs)
+
         # Create collection if it doesn't exist
         self._ensure_collection()
 
-    def _ensure_collection(self):
+        # readiness is answered from the state of the last background health check
+        self.health_check_interval = health_check_interval
+        self._healthy = False
+        self._health_checked_at = float('-inf')
+        self._health_checker_pid = None
+        self._health_lock = threading.Lock()
+
+    @property
+    def client(self) -> QdrantClient:
+        if self.client_strategy == 'thread_local':
+            client = getattr(self._thread_clients, 'client', None)
+            if client is None:
+                client = self._thread_clients.client = create_qdrant_client(self.url, self.api_key,
+                                                                            self.transport_configs)
+            return client
+        return self._client
+
+    def reconnect(self):
+        """Open a fresh client, e.g. in a forked server worker that must not share the parent's sockets"""
+        if self.url == ':memory:':
+            # a new in-process client would start from an empty database
+            return
+        self._client = create_qdrant_client(self.url, self.api_key, self.transport_configs)
+        self._thread_clients = threading.local()
+
+    def _check_health(self):
         try:
-            self.client.get_collection(self.collection_name)
-        except exceptions.UnexpectedResponse as e:
-            if e.status_code == 404:  # Not Found
-                self.client.create_collection(
+            if not self.uses_local_store:
+                collection = self.client.get_collection(self.collection_name)
+                healthy = collection.status != models.CollectionStatus.RED
+            else:
+                healthy = True
+        except Exception as e:
+            logger.warning(f'Qdrant health check failed: {e}')
+            healthy = False
+        self._healthy, self._health_checked_at = healthy, time.monotonic()
+
+    def _run_health_checks(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            self._check_health()
+
+    def is_healthy(self) -> bool:
+        """
+        Cached health of the collection, refreshed every `health_check_interval` seconds by a background
+        thread, so readiness probes never reach Qdrant. The thread is started on first use in every
+        process, threads do not survive the fork of server workers. A state not refreshed for three
+        intervals (a hanging check) counts as unhealthy.
+        """
+        if self._health_checker_pid != os.getpid():
+            with self._health_lock:
+                if self._health_checker_pid != os.getpid():
+                    self._check_health()
+                    threading.Thread(target=self._run_health_checks, name='qdrant-health', daemon=True).start()
+                    self._health_checker_pid = os.getpid()
+        return self._healthy and time.monotonic() - self._health_checked_at < 3 * self.health_check_interval
+
+    def _ensure_collection(self):
+        if self.uses_local_store:
+            return
+        # works the same for the server and the in-process Qdrant, which has no 404 to catch
+        if not self.client.collection_exists(self.collection_name):
+            profile = self.collection_profile
+            hnsw_config = models.HnswConfigDiff(**profile['hnsw_configs']) if profile.get('hnsw_configs') else None
+            self.client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=models.VectorParams(
+                    size=self.clip_encoder.projection_dim,
+                    distance=models.Distance.COSINE,
+                    on_disk=profile.get('on_disk_vectors'),
+                ),
+                hnsw_config=hnsw_config,
+                quantization_config=self._quantization_config(profile.get('quantization')),
+                on_disk_payload=profile.get('on_disk_payload'),
+            )
+            self.index_filter_fields()
+
+    @staticmethod
+    def _quantization_config(quantization: Dict | None):
+        if not quantization:
+            return None
+        always_ram = quantization.get('always_ram', True)
+        if quantization['type'] == 'scalar':
+            return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=quantization.get('quantile'),
+                always_ram=always_ram,
+            ))
+        if quantization['type'] == 'binary':
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=always_ram))
+        raise ValueError(f'Unsupported quantization type {quantization["type"]}')
+
+    def apply_collection_profile(self):
+        """Update an existing collection to the configured profile, Qdrant re-optimizes it in the background"""
+        profile = self.collection_profile
+        hnsw_config = models.HnswConfigDiff(**profile['hnsw_configs']) if profile.get('hnsw_configs') else None
+        self.client.update_collection(
+            collection_name=self.collection_name,
+            vectors_config={'': models.VectorParamsDiff(on_disk=profile.get('on_disk_vectors'))},
+            hnsw_config=hnsw_config,
+            quantization_config=self._quantization_config(profile.get('quantization')) or models.Disabled.DISABLED,
+            collection_params=models.CollectionParamsDiff(on_disk_payload=profile.get('on_disk_payload')),
+        )
+        self.index_filter_fields()
+        logger.info(f'applied the collection profile to {self.collection_name}')
+
+    def index_filter_fields(self):
+        """Create keyword payload indexes on the fields queries filter on"""
+        for field_name in self.filter_index_fields:
+            try:
+                self.client.create_payload_index(
                     collection_name=self.collection_name,
-                    vectors_config=models.VectorParams(
-                        size=self.clip_encoder.model.config.projection_dim,
-                        distance=models.Distance.COSINE,
-                    )
+                    field_name=field_name,
+                    field_schema=models.PayloadSchemaType.KEYWORD,
                 )
+            except exceptions.UnexpectedResponse as e:
+                logger.error(f'Error occurred, indexing {field_name}.')
+                logger.error(e)
+
+    def _search_params(self,
+                       hnsw_ef: int | None = None,
+                       oversampling: float | None = None) -> models.SearchParams | None:
+        """Search params of a request, falling back to the configured `search_params`"""
+        hnsw_ef = hnsw_ef or self.search_configs.get('hnsw_ef')
+        quantization = None
+        if self.collection_profile.get('quantization'):
+            quantization = models.QuantizationSearchParams(
+                rescore=self.search_configs.get('rescore', True),
+                oversampling=oversampling or self.search_configs.get('oversampling'),
+            )
+        if hnsw_ef is None and quantization is None:
+            return None
+        return models.SearchParams(hnsw_ef=hnsw_ef, quantization=quantization)
 
     def index_keywords(self, field_name: str, params: Dict):
         try:
@@ -53,88 +274,533 @@ class QdrantManager:
             logger.error(f'Error occurred, indexing {field_name}.')
             logger.error(e)
 
-    def insert_batch(self, products: List[Product], insertion_batch_size=64):
-        for batch_start in range(1410, len(products), insertion_batch_size):
-            batch_end = batch_start + insertion_batch_size
+    def catalog_changed(self):
+        self.catalog_modified = True
+        if self.catalog_version is not None:
+            self.catalog_version.bump()
+
+    def index_keyword_points(self, points: Iterable[models.PointStruct]):
+        if self.keyword_index is not None:
+            self.keyword_index.upsert((point.id, point.payload) for point in points)
+
+    def save_keyword_index(self):
+        """Make the indexed keywords visible to the serving processes"""
+        if self.keyword_index is not None:
+            with indexer_stage('keyword_index'):
+                saved = self.keyword_index.save()
+            if saved:
+                # serving processes reload the index when the version changes, pages of the old one are dropped
+                self.catalog_changed()
+
+    def build_keyword_index(self, batch_size: int = 256):
+        """Rebuild the keyword index from the payloads of the collection"""
+        if self.keyword_index is None:
+            raise ValueError('the keyword index is not enabled')
+        self.keyword_index.build_from_qdrant(self.client, self.collection_name, batch_size)
+        logger.info(f'indexed the keywords of {len(self.keyword_index)} products')
+
+    def insert_batch(self,
+                     products: Iterable[Product],
+                     insertion_batch_size=64,
+                     image_downloader: 'ImageDownloader | None' = None,
+                     prefetch_batches: int = 2,
+                     inference_batch_size: int = 32,
+                     embedding_cache: EmbeddingCache | None = None,
+                     start_offset: int = 0,
+                     checkpoint: IndexCheckpoint | None = None,
+                     upload_pipeline: UploadPipeline | None = None):
+        image_downloader = image_downloader or self.clip_encoder.image_downloader
+        if embedding_cache is None:
+            embedding_cache = self.clip_encoder.embedding_cache
+        products = iter(products)
+        for _ in islice(products, start_offset):
+            pass
+
+        # images of the upcoming batches are downloaded while the current one is encoded
+        pending_batches = deque()
+        # downloads of the pending batches by URL, with the batch that started them,
+        # so a URL repeated within the prefetch window is downloaded and encoded once
+        scheduled_downloads: Dict[str, Tuple] = {}
+
+        def image_source(url, batch_start):
+            if url in scheduled_downloads:
+                return scheduled_downloads[url]
+            # a known URL skips the download entirely unless the content has to be verified
+            if embedding_cache is not None and not embedding_cache.verify_content:
+                embedding = embedding_cache.get(url)
+                if embedding is not None:
+                    return embedding
+            scheduled_downloads[url] = (batch_start, image_downloader.submit(url, with_hash=True))
+            return scheduled_downloads[url]
+
+        def resolve_image(url, source, batch_start):
+            if isinstance(source, np.ndarray):
+                return url, None, source
+            download_batch_start, download = source
+            if (embedding_cache is not None and not embedding_cache.verify_content
+                    and download_batch_start != batch_start):
+                # downloaded for an earlier batch, which has cached the embedding by now
+                embedding = embedding_cache.get(url)
+                if embedding is not None:
+                    return url, None, embedding
+            image, image_hash = download.result()
+            if embedding_cache is not None and embedding_cache.verify_content:
+                embedding = embedding_cache.get(url, image_hash)
+                if embedding is not None:
+                    return url, image_hash, embedding
+            return url, image_hash, image
+
+        def schedule_batch(batch_start):
+            batch = list(islice(products, insertion_batch_size))
+            if not batch:
+                return False
+            image_sources = [[image_source(image, batch_start) for image in product.images]
+                             for product in batch]
+            pending_batches.append((batch_start, batch, image_sources))
+            return True
+
+        # batches are uploaded in the background while the next ones are encoded
+        owns_upload_pipeline = upload_pipeline is None
+        if owns_upload_pipeline:
+            upload_pipeline = UploadPipeline(self.client, self.collection_name)
 
-            batch_points = []
+        def on_uploaded(uploaded_products, uploaded_points):
+            self.index_keyword_points(uploaded_points)
+            if checkpoint is not None:
+                checkpoint.mark_indexed(uploaded_products)
+                checkpoint.flush()
+            self.catalog_changed()
 
-            logger.info(f'start encoding items [{batch_start}, {batch_end}])')
+        started_at = time.perf_counter()
+        total_products, total_images = 0, 0
+        next_batch_start = start_offset
+        exhausted = False
+
+        try:
+            while not exhausted or pending_batches:
+                while not exhausted and len(pending_batches) <= prefetch_batches:
+                    exhausted = not schedule_batch(next_batch_start)
+                    next_batch_start += insertion_batch_size
+                if not pending_batches:
+                    break
+
+                batch_start, batch, image_sources = pending_batches.popleft()
+                batch_end = batch_start + insertion_batch_size
+                # the batches scheduled from now on find these images in the cache once this one is encoded
+                for url in [url for url, (download_batch_start, _) in scheduled_downloads.items()
+                            if download_batch_start == batch_start]:
+                    del scheduled_downloads[url]
+
+                batch_points = []
+
+                logger.info(f'start encoding items [{batch_start}, {batch_end}])')
+
+                batch_products, batch_images = [], []
+                for product, sources in zip(batch, image_sources):
+                    try:
+                        images = [resolve_image(url, source, batch_start)
+                                  for url, source in zip(product.images, sources)]
+                        if not images:
+                            raise ValueError('product has no images')
+                        batch_products.append(product)
+                        batch_images.append(images)
+                    except ValueError as e:
+                        logger.error(f'error encoding images {[image for image in product.images]}')
+                        logger.error(e)
 
-            for product in products[batch_start:batch_end]:
                 try:
-                    product_encoding = self.clip_encoder.encode_image(images=[image for image in product.images],
-                                                                      is_url=True)
-                    vector_record = product.to_vector_record(product_encoding)
-                    batch_points.append(models.PointStruct(**vector_record))
+                    with indexer_stage('encode'):
+                        product_encodings = self._encode_products(batch_images, inference_batch_size,
+                                                                  embedding_cache)
                 except ValueError as e:
-                    logger.error(f'error encoding images {[image for image in product.images]}')
+                    logger.error(f'error encoding items [{batch_start}, {batch_end}])')
                     logger.error(e)
+                    continue
+
+                if embedding_cache is not None:
+                    embedding_cache.flush()
+                    cache_hits = sum(isinstance(source, np.ndarray)
+                                     for images in batch_images for _, _, source in images)
+                    cache_misses = sum(len(images) for images in batch_images) - cache_hits
+                    logger.info(f'embedding cache: {cache_hits} hits, {cache_misses} misses')
+
+                for product, images, product_encoding in zip(batch_products, batch_images, product_encodings):
+                    vector_record = product.to_vector_record(product_encoding.tolist())
+                    batch_points.append(models.PointStruct(**vector_record))
+                    total_images += len(images)
+
+                logger.info(f'start inserting items [{batch_start}, {batch_end}])')
+
+                upload_pipeline.submit(batch_points, on_uploaded=partial(on_uploaded, batch_products, batch_points))
 
-            logger.info(f'start inserting items [{batch_start}, {batch_end}])')
+                total_products += len(batch_points)
+                elapsed = time.perf_counter() - started_at
+                logger.info(f'throughput: {total_images / elapsed:.2f} images/sec, '
+                            f'{total_products / elapsed:.2f} products/sec')
+        finally:
+            if owns_upload_pipeline:
+                try:
+                    upload_pipeline.close()
+                finally:
+                    self.save_keyword_index()
+                    if upload_pipeline.uploaded_points:
+                        # once more after the barrier, every uploaded point is searchable by now
+                        self.catalog_changed()
+
+        elapsed = time.perf_counter() - started_at
+        logger.info(f'inserted {total_products} products ({total_images} images) in {elapsed:.1f}s')
 
-            self.client.upsert(
+    def sync_products(self,
+                      products: Iterable[Product],
+                      checkpoint: IndexCheckpoint,
+                      insertion_batch_size=64,
+                      **insert_kwargs):
+        """
+        Bring the collection in line with the catalog, doing only as much work as the delta requires:
+        products with new or changed images are re-embedded, payload-only changes are written with
+        `overwrite_payload` and products missing from the catalog are deleted.
+        The catalog is consumed as a stream, only the delta is ever held in memory.
+        """
+        catalog_ids = set()
+        payload_only = []
+        delta = {'embedded': 0, 'payload': 0, 'unchanged': 0}
+
+        def flush_payload_updates():
+            if not payload_only:
+                return
+            self.client.batch_update_points(
                 collection_name=self.collection_name,
-                points=batch_points,
+                update_operations=[models.OverwritePayloadOperation(
+                    overwrite_payload=models.SetPayload(payload=product.to_payload(), points=[product.uuid]))
+                    for product in payload_only],
             )
+            self.index_keyword_points(models.PointStruct(id=product.uuid, vector=[], payload=product.to_payload())
+                                      for product in payload_only)
+            checkpoint.mark_indexed(payload_only)
+            checkpoint.flush()
+            payload_only.clear()
+            self.catalog_changed()
+
+        def changed_products():
+            for product in products:
+                catalog_ids.add(product.id)
+                entry = checkpoint.get(product.id)
+                if entry is None or entry['images_hash'] != checkpoint.images_hash(product):
+                    delta['embedded'] += 1
+                    yield product
+                elif entry['payload_hash'] != checkpoint.payload_hash(product):
+                    delta['payload'] += 1
+                    payload_only.append(product)
+                    if len(payload_only) >= insertion_batch_size:
+                        flush_payload_updates()
+                else:
+                    delta['unchanged'] += 1
+
+        self.insert_batch(changed_products(),
+                          insertion_batch_size=insertion_batch_size,
+                          checkpoint=checkpoint,
+                          **insert_kwargs)
+        flush_payload_updates()
+        upload_pipeline = insert_kwargs.get('upload_pipeline')
+        if upload_pipeline is not None:
+            # the caller's pipeline is still open, its last batches mark their products indexed
+            upload_pipeline.drain()
+
+        removed_ids = [product_id for product_id in checkpoint.indexed_ids() if product_id not in catalog_ids]
+        if removed_ids and catalog_ids:
+            for batch_start in range(0, len(removed_ids), insertion_batch_size):
+                batch = removed_ids[batch_start:batch_start + insertion_batch_size]
+                self.client.delete(
+                    collection_name=self.collection_name,
+                    points_selector=models.PointIdsList(points=[Product.generate_uuid(product_id)
+                                                                for product_id in batch]),
+                )
+                if self.keyword_index is not None:
+                    self.keyword_index.delete(Product.generate_uuid(product_id) for product_id in batch)
+                checkpoint.mark_deleted(batch)
+                checkpoint.flush()
+                self.catalog_changed()
+        elif removed_ids:
+            logger.warning('catalog is empty, skipping deletion of indexed products')
+
+        if insert_kwargs.get('upload_pipeline') is None:
+            # otherwise the caller saves once it has closed its pipeline
+            self.save_keyword_index()
+        logger.info(f'catalog delta: {delta["embedded"]} embedded, {delta["payload"]} payload updates, '
+                    f'{len(removed_ids) if catalog_ids else 0} deleted, {delta["unchanged"]} unchanged')
+
+        checkpoint.compact()
+
+    def _encode_products(self,
+                         products_images: List[List[Tuple[str, str | None, 'Image.Image | np.ndarray']]],
+                         inference_batch_size: int,
+                         embedding_cache: EmbeddingCache | None = None) -> np.ndarray:
+        """
+        Encode the images of all products at once and average them per product.
+        Every image is a (url, content_hash, image) tuple where image is either a PIL Image
+        or an embedding already served by the cache.
+        """
+        flat_images = [image for images in products_images for image in images]
+        image_counts = np.array([len(images) for images in products_images])
+        owners = np.repeat(np.arange(len(products_images)), image_counts)
+
+        embeddings = np.empty((len(flat_images), self.clip_encoder.projection_dim), dtype=np.float32)
+        to_encode = []
+        for index, (_, _, source) in enumerate(flat_images):
+            if isinstance(source, np.ndarray):
+                embeddings[index] = source
+            else:
+                to_encode.append(index)
+
+        if to_encode:
+            # an image repeated in the batch is encoded once
+            first_indexes = {}
+            for index in to_encode:
+                first_indexes.setdefault(flat_images[index][0], index)
+            unique = list(first_indexes.values())
+            encoded = self.clip_encoder.encode_images([flat_images[index][2] for index in unique],
+                                                      batch_size=inference_batch_size)
+            encoded_by_url = dict(zip(first_indexes, encoded))
+            embeddings[to_encode] = [encoded_by_url[flat_images[index][0]] for index in to_encode]
+            count_indexed('encode', len(unique))
+            if embedding_cache is not None:
+                for index, embedding in zip(unique, encoded):
+                    url, image_hash, _ = flat_images[index]
+                    embedding_cache.put(url, image_hash, embedding)
+
+        # because we use `dot products`/`cosine` at the end
+        # the mean of the image vectors is used as the product representor
+        product_encodings = np.zeros((len(products_images), embeddings.shape[1]), dtype=embeddings.dtype)
+        np.add.at(product_encodings, owners, embeddings)
+        return product_encodings / image_counts[:, None]
 
     def add_product(self, product: Product):
-        image_embedding = self.clip_encoder.encode_image(product.image_url, is_url=True)
+        image_embedding = self.clip_encoder.encode_image(product.images, is_url=True)
         vector_record = product.to_vector_record(image_embedding)
+        point = models.PointStruct(**vector_record)
         self.client.upsert(
             collection_name=self.collection_name,
-            points=[models.PointStruct(**vector_record)],
+            points=[point],
+            wait=True,
         )
+        # searchable by this process right away, by the others once the index is saved
+        self.index_keyword_points([point])
+        self.catalog_changed()
 
     def search_products_by_text(self,
                                 text: str,
                                 top_k: int = 10,
-                                query_filter: models.Filter | None = None) -> List[Dict]:
+                                query_filter: models.Filter | None = None,
+                                hnsw_ef: int | None = None,
+                                oversampling: float | None = None) -> List[Dict]:
 
-        text_embedding = self.clip_encoder.encode_text(text)
-        search_result = self.client.search(
-            collection_name=self.collection_name,
-            query_filter=query_filter,
-            query_vector=text_embedding,
-            limit=top_k,
-        )
+        with timed('encode_text'):
+            text_embedding = self.text_encoder.encode_text(text)
+        return self._search_products_by_vector(text_embedding, top_k, query_filter, hnsw_ef, oversampling)
 
-        results = []
-        for point in search_result:
-            product = Product(**point.payload)
-            results.append({'product': product, 'similarity_score': point.score})
+    def search_products_by_image(self,
+                                 images: List['Image.Image'],
+                                 top_k: int = 10,
+                                 query_filter: models.Filter | None = None,
+                                 hnsw_ef: int | None = None,
+                                 oversampling: float | None = None) -> List[Dict]:
+        """Search with the mean embedding of in-memory images, like the indexed products"""
+        with timed('encode_image'):
+            image_embedding = self.clip_encoder.encode_image(images, is_url=False)
+        return self._search_products_by_vector(image_embedding, top_k, query_filter, hnsw_ef, oversampling)
 
-        return results
+    def search_similar_products(self,
+                                product_id: int,
+                                top_k: int = 10,
+                                query_filter: models.Filter | None = None,
+                                hnsw_ef: int | None = None,
+                                oversampling: float | None = None) -> List[Dict] | None:
+        """
+        "More like this" search with the stored vector of a product, without any inference.
 
-    def search_products_by_keyword(self,
-                                   text: str,
-                                   top_k: int = 10,
-                                   query_filter: models.Filter | None = None) -> List[Dict]:
+        Returns:
+            List[Dict] | None: The most similar other products, None if the product is not indexed
+        """
+        product_uuid = Product.generate_uuid(product_id)
+        with timed('retrieve'):
+            points = self.vector_store.retrieve([product_uuid], with_vectors=True)
+        if not points:
+            return None
+
+        exclude_product = models.HasIdCondition(has_id=[product_uuid])
+        if query_filter is not None:
+            query_filter = query_filter.model_copy(update={'must_not': [*(query_filter.must_not or []),
+                                                                        exclude_product]})
+        else:
+            query_filter = models.Filter(must_not=[exclude_product])
+        return self._search_products_by_vector(points[0].vector, top_k, query_filter, hnsw_ef, oversampling)
+
+    def _search_products_by_vector(self,
+                                   vector: List[float],
+                                   top_k: int,
+                                   query_filter: models.Filter | None,
+                                   hnsw_ef: int | None,
+                                   oversampling: float | None) -> List[Dict]:
+        with timed('vector_search'):
+            search_result = self.vector_store.search(vector, top_k=top_k, query_filter=query_filter,
+                                                     with_payload=ProductHit.payload_fields,
+                                                     search_params=self._search_params(hnsw_ef, oversampling))
+
+        with timed('hits'):
+            return [{'product': ProductHit.from_point(point), 'similarity_score': point.score}
+                    for point in search_result]
 
+    def encode_texts(self, texts: List[str]) -> List[List[float]]:
+        """Encode the texts of many queries in a single forward pass"""
+        with timed('encode_text'):
+            return self.clip_encoder.encode_texts(texts)
+
+    def search_products_by_vectors(self, searches: List[Dict]) -> List[List[Dict]]:
+        """
+        Run many vector searches in a single request.
+
+        Args:
+            searches (List[Dict]): The `vector`, `top_k`, `query_filter`, `hnsw_ef` and `oversampling` of every search
+
+        Returns:
+            List[List[Dict]]: The hits of every search, in order
+        """
+        requests = [models.SearchRequest(vector=search['vector'],
+                                         filter=search.get('query_filter'),
+                                         limit=search.get('top_k', 10),
+                                         params=self._search_params(search.get('hnsw_ef'), search.get('oversampling')),
+                                         with_payload=ProductHit.payload_fields)
+                    for search in searches]
+        with timed('vector_search'):
+            search_results = self.vector_store.search_batch(requests)
+
+        with timed('hits'):
+            return [[{'product': ProductHit.from_point(point), 'similarity_score': point.score} for point in points]
+                    for points in search_results]
+
+    def _keyword_filter(self, text: str, query_filter: models.Filter | None = None) -> models.Filter:
         text_filter = models.FieldCondition(
             key=self.text_index_name,
             match=models.MatchText(text=text),
         )
 
         if query_filter is not None:
-            query_filter.must.append(text_filter)
-        else:
-            query_filter = models.Filter(
-                must=[text_filter],
+            # copy so the caller's filter is left untouched for concurrent searches
+            return query_filter.model_copy(update={'must': [*(query_filter.must or []), text_filter]})
+        return models.Filter(
+            must=[text_filter],
+        )
+
+    def search_products_by_keyword(self,
+                                   text: str,
+                                   top_k: int = 10,
+                                   query_filter: models.Filter | None = None,
+                                   offset: int = 0) -> List[Dict]:
+        """
+        Products matching the keywords of `text`, ranked by BM25 with the keyword index.
+        Without it, or for filters on fields it does not store, the matches come from Qdrant's
+        full text index, unranked.
+        """
+        if self.keyword_index is not None and self.keyword_index.supports_filter(query_filter):
+            with timed('keyword_search'):
+                search_result = self.keyword_index.search(text, top_k, query_filter, offset)
+            with timed('hits'):
+                return [{'product': ProductHit.from_point(point), 'keyword_score': point.score}
+                        for point in search_result]
+
+        with timed('keyword_search'):
+            search_result = self.vector_store.scroll(self._keyword_filter(text, query_filter), limit=offset + top_k,
+                                                     with_payload=ProductHit.payload_fields)
+
+        with timed('hits'):
+            return [{'product': ProductHit.from_point(point)} for point in search_result[offset:]]
+
+    @property
+    def supports_server_side_fusion(self) -> bool:
+        """Whether the Qdrant server has the query API with prefetch and fusion (v1.10+)"""
+        if self.keyword_index is not None:
+            # the keyword leg of Qdrant's fusion would bypass the BM25 ranking
+            return False
+        if self._supports_server_side_fusion is None:
+            try:
+                version = tuple(int(part) for part in self.client.info().version.split('.')[:2])
+                self._supports_server_side_fusion = hasattr(self.client, 'query_points') and version >= (1, 10)
+            except Exception as e:
+                logger.warning(f'could not detect the Qdrant version, fusing hybrid results client-side: {e}')
+                self._supports_server_side_fusion = False
+        return self._supports_server_side_fusion
+
+    def search_products_hybrid(self,
+                               text: str,
+                               top_k: int = 10,
+                               query_filter: models.Filter | None = None,
+                               candidate_depth: int = 50,
+                               hnsw_ef: int | None = None,
+                               oversampling: float | None = None) -> List[Dict]:
+        """
+        Hybrid search in a single round trip: Qdrant prefetches the semantic candidates and the
+        keyword matches (ranked by their similarity to the query) and fuses both with RRF.
+        """
+        with timed('encode_text'):
+            text_embedding = self.text_encoder.encode_text(text)
+        hybrid_query = self._hybrid_query(text, text_embedding, top_k, query_filter, candidate_depth,
+                                          hnsw_ef, oversampling)
+        with timed('hybrid_search'):
+            search_result = self.client.query_points(
+                collection_name=self.collection_name,
+                prefetch=hybrid_query.prefetch,
+                query=hybrid_query.query,
+                limit=hybrid_query.limit,
+                with_payload=hybrid_query.with_payload,
             )
 
-        search_result = self.client.scroll(
-            collection_name=self.collection_name,
-            scroll_filter=query_filter,
-            limit=top_k,
-            with_payload=True,
-            with_vectors=False,
-        )
+        with timed('hits'):
+            return self._fusion_hits(search_result)
 
-        results = []
+    def search_products_hybrid_batch(self, searches: List[Dict]) -> List[List[Dict]]:
+        """
+        Run many hybrid searches with server-side fusion in a single request.
 
-        for point in search_result[0]:
-            product = Product(**point.payload)
-            results.append({'product': product})
+        Args:
+            searches (List[Dict]): The `text`, `vector` and the keyword arguments of `search_products_hybrid`
+                of every search
 
-        return results
+        Returns:
+            List[List[Dict]]: The hits of every search, in order
+        """
+        requests = [self._hybrid_query(search['text'], search['vector'], search.get('top_k', 10),
+                                       search.get('query_filter'), search.get('candidate_depth', 50),
+                                       search.get('hnsw_ef'), search.get('oversampling'))
+                    for search in searches]
+        with timed('hybrid_search'):
+            search_results = self.client.query_batch_points(collection_name=self.collection_name, requests=requests)
+
+        with timed('hits'):
+            return [self._fusion_hits(search_result) for search_result in search_results]
+
+    def _hybrid_query(self,
+                      text: str,
+                      text_embedding: List[float],
+                      top_k: int,
+                      query_filter: models.Filter | None,
+                      candidate_depth: int,
+                      hnsw_ef: int | None,
+                      oversampling: float | None) -> models.QueryRequest:
+        """Prefetch the semantic candidates and the keyword matches (ranked by similarity) and fuse both with RRF"""
+        search_params = self._search_params(hnsw_ef, oversampling)
+        return models.QueryRequest(
+            prefetch=[
+                models.Prefetch(query=text_embedding, filter=query_filter, params=search_params,
+                                limit=candidate_depth),
+                models.Prefetch(query=text_embedding, filter=self._keyword_filter(text, query_filter),
+                                params=search_params, limit=candidate_depth),
+            ],
+            query=models.FusionQuery(fusion=models.Fusion.RRF),
+            limit=top_k,
+            with_payload=ProductHit.payload_fields,
+        )
+
+    @staticmethod
+    def _fusion_hits(search_result: models.QueryResponse) -> List[Dict]:
+        return [{'product': ProductHit.from_point(point), 'fusion_score': point.score}
+                for point in search_result.points]
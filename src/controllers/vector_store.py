@@ -0,0 +1,330 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+from qdrant_client import QdrantClient, models
+
+
+class VectorStore(ABC):
+    """Storage of the product vectors and payloads the search runs against"""
+
+    @abstractmethod
+    def search(self,
+               vector: Sequence[float],
+               top_k: int = 10,
+               query_filter: models.Filter | None = None,
+               with_payload: bool | List[str] = True,
+               search_params: models.SearchParams | None = None) -> List[models.ScoredPoint]:
+        """
+        Return the `top_k` points most similar (cosine) to `vector` that match `query_filter`.
+        `with_payload` may list the payload fields to return, a store is free to return more.
+        `search_params` (HNSW ef, quantization rescoring) only apply to approximate stores.
+        """
+
+    @abstractmethod
+    def scroll(self,
+               query_filter: models.Filter | None = None,
+               limit: int = 10,
+               with_payload: bool | List[str] = True) -> List[models.Record]:
+        """Return up to `limit` points matching `query_filter`"""
+
+    @abstractmethod
+    def retrieve(self, ids: List[str], with_vectors: bool = False) -> List[models.Record]:
+        """Return the points with the given ids that exist, optionally with their vectors"""
+
+    def search_batch(self, requests: List[models.SearchRequest]) -> List[List[models.ScoredPoint]]:
+        """Run several searches at once, returning the results of every request in order"""
+        return [self.search(search.vector, top_k=search.limit, query_filter=search.filter,
+                            with_payload=search.with_payload, search_params=search.params)
+                for search in requests]
+
+
+class QdrantVectorStore(VectorStore):
+    def __init__(self, get_client: Callable[[], QdrantClient], collection_name: str):
+        """
+        Args:
+            get_client (Callable[[], QdrantClient]): Returns the client of the calling thread
+            collection_name (str): Name of the collection searched
+        """
+        self.get_client = get_client
+        self.collection_name = collection_name
+
+    @property
+    def client(self) -> QdrantClient:
+        return self.get_client()
+
+    def search(self, vector, top_k=10, query_filter=None, with_payload=True, search_params=None):
+        return self.client.search(
+            collection_name=self.collection_name,
+            query_filter=query_filter,
+            query_vector=vector,
+            limit=top_k,
+            with_payload=with_payload,
+            search_params=search_params,
+        )
+
+    def retrieve(self, ids, with_vectors=False):
+        return self.client.retrieve(
+            collection_name=self.collection_name,
+            ids=ids,
+            with_payload=False,
+            with_vectors=with_vectors,
+        )
+
+    def search_batch(self, requests):
+        # a single round trip, Qdrant runs the searches of the batch in parallel
+        return self.client.search_batch(collection_name=self.collection_name, requests=requests)
+
+    def scroll(self, query_filter=None, limit=10, with_payload=True):
+        return self.client.scroll(
+            collection_name=self.collection_name,
+            scroll_filter=query_filter,
+            limit=limit,
+            with_payload=with_payload,
+            with_vectors=False,
+        )[0]
+
+
+class ValueColumn:
+    """
+    Values of a payload field as int32 codes into `values`: one code per row (-1 when missing) for
+    scalar fields, or the codes of every row in CSR layout (`indptr`) for fields holding lists.
+    """
+
+    def __init__(self, values: List, codes: np.ndarray, indptr: Optional[np.ndarray] = None):
+        self.values = values
+        self.codes_by_value = {value: code for code, value in enumerate(values)}
+        self.codes = codes
+        self.indptr = indptr
+
+    @classmethod
+    def from_values(cls, row_values: Iterable) -> 'ValueColumn':
+        """Column of the payload values of the rows (None, a value or a list of values)"""
+        values, codes_by_value = [], {}
+        row_codes, is_list = [], False
+        for value in row_values:
+            is_list |= isinstance(value, list)
+            codes = []
+            for item in value if isinstance(value, list) else [value]:
+                if item is None or not isinstance(item, Hashable):
+                    continue
+                code = codes_by_value.get(item)
+                if code is None:
+                    code = codes_by_value[item] = len(values)
+                    values.append(item)
+                codes.append(code)
+            row_codes.append(codes)
+
+        if not is_list:
+            return cls(values, np.asarray([codes[0] if codes else -1 for codes in row_codes], dtype=np.int32))
+        indptr = np.zeros(len(row_codes) + 1, dtype=np.int64)
+        np.cumsum([len(codes) for codes in row_codes], out=indptr[1:])
+        return cls(values, np.asarray([code for codes in row_codes for code in codes], dtype=np.int32), indptr)
+
+    @classmethod
+    def load(cls, prefix: str) -> 'ValueColumn':
+        with open(f'{prefix}.values.json', 'r') as values:
+            values = json.load(values)
+        indptr = np.load(f'{prefix}.indptr.npy', mmap_mode='r') if os.path.exists(f'{prefix}.indptr.npy') else None
+        return cls(values, np.load(f'{prefix}.codes.npy', mmap_mode='r'), indptr)
+
+    def save(self, prefix: str):
+        with open(f'{prefix}.values.json', 'w') as values:
+            json.dump(self.values, values, default=str)
+        np.save(f'{prefix}.codes.npy', self.codes)
+        if self.indptr is not None:
+            np.save(f'{prefix}.indptr.npy', self.indptr)
+
+    def __len__(self):
+        return len(self.codes) if self.indptr is None else len(self.indptr) - 1
+
+    def value(self, row: int):
+        """Payload value of `row`"""
+        if self.indptr is None:
+            code = int(self.codes[row])
+            return self.values[code] if code >= 0 else None
+        return [self.values[code] for code in self.codes[self.indptr[row]:self.indptr[row + 1]]]
+
+    def mask(self, values: Iterable) -> np.ndarray:
+        """Rows holding any of `values`"""
+        codes = [self.codes_by_value[value] for value in values if value in self.codes_by_value]
+        matches = np.isin(self.codes, codes)
+        if self.indptr is None:
+            return matches
+        owners = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        mask = np.zeros(len(self), dtype=bool)
+        mask[owners[matches]] = True
+        return mask
+
+
+class PayloadFilter:
+    """
+    Evaluates Qdrant filters over in-memory rows. Field values are held as `ValueColumn`s, given or
+    built when the filter is created for `filter_fields` and on first use for any other field of
+    `payloads`, and the masks of a filter are computed from the columns at query time.
+    """
+
+    def __init__(self,
+                 size: int,
+                 ids: Optional[List] = None,
+                 payloads: Optional[List[Dict]] = None,
+                 filter_fields: Sequence[str] = (),
+                 columns: Optional[Dict[str, ValueColumn]] = None):
+        self.size = size
+        self.ids = ids
+        self.payloads = payloads
+        self.columns: Dict[str, ValueColumn] = dict(columns or {})
+        self._lock = Lock()
+        for field in filter_fields:
+            self._column(field)
+
+    def _column(self, field: str) -> ValueColumn:
+        column = self.columns.get(field)
+        if column is None:
+            if self.payloads is None:
+                raise ValueError(f'Unsupported filter field for local payloads: {field}')
+            column = ValueColumn.from_values(payload.get(field) for payload in self.payloads)
+            with self._lock:
+                self.columns[field] = column
+        return column
+
+    def _text_mask(self, field: str, text: str) -> np.ndarray:
+        if self.payloads is None:
+            raise ValueError(f'Unsupported text filter for local payloads: {field}')
+        # like Qdrant's full text match: every token of the query appears in the field
+        tokens = text.lower().split()
+        return np.fromiter((all(token in str(payload.get(field, '')).lower().split() for token in tokens)
+                            for payload in self.payloads),
+                           dtype=bool, count=self.size)
+
+    def _condition_mask(self, condition) -> np.ndarray:
+        if isinstance(condition, models.Filter):
+            return self.mask(condition)
+        if isinstance(condition, models.HasIdCondition) and self.ids is not None:
+            ids = {str(point_id) for point_id in condition.has_id}
+            return np.fromiter((str(point_id) in ids for point_id in self.ids), dtype=bool, count=self.size)
+        if isinstance(condition, models.FieldCondition):
+            if isinstance(condition.match, models.MatchValue):
+                return self._column(condition.key).mask([condition.match.value])
+            if isinstance(condition.match, models.MatchAny):
+                return self._column(condition.key).mask(condition.match.any)
+            if isinstance(condition.match, models.MatchText):
+                return self._text_mask(condition.key, condition.match.text)
+        raise ValueError(f'Unsupported filter condition for local payloads: {condition}')
+
+    def mask(self, query_filter: models.Filter | None) -> Optional[np.ndarray]:
+        """Rows matching `query_filter`, None for no filter"""
+        if query_filter is None:
+            return None
+
+        mask = np.ones(self.size, dtype=bool)
+        for condition in query_filter.must or []:
+            mask &= self._condition_mask(condition)
+        if query_filter.should:
+            mask &= np.logical_or.reduce([self._condition_mask(condition) for condition in query_filter.should])
+        for condition in query_filter.must_not or []:
+            mask &= ~self._condition_mask(condition)
+        return mask
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process exact search over vectors exported from a Qdrant collection.
+
+    The store directory holds `vectors.f32`, a memory-mapped float32 matrix of L2-normalized vectors
+    (so cosine similarity is a dot product), `points.jsonl` with the id and payload of every row and
+    `meta.json`. Payload filters are evaluated by a `PayloadFilter` over the payloads.
+    """
+    vectors_file = 'vectors.f32'
+    points_file = 'points.jsonl'
+    meta_file = 'meta.json'
+
+    def __init__(self, path: str, filter_fields: Sequence[str] = ()):
+        with open(os.path.join(path, self.meta_file), 'r') as meta:
+            meta = json.load(meta)
+
+        self.path = path
+        self.dim = meta['dim']
+        self.size = meta['size']
+        self.vectors = np.memmap(os.path.join(path, self.vectors_file), dtype=np.float32, mode='r',
+                                 shape=(self.size, self.dim)) if self.size else np.empty((0, self.dim), np.float32)
+
+        self.ids, self.payloads = [], []
+        with open(os.path.join(path, self.points_file), 'r') as points:
+            for line in points:
+                point = json.loads(line)
+                self.ids.append(point['id'])
+                self.payloads.append(point['payload'])
+
+        self._rows = {str(point_id): row for row, point_id in enumerate(self.ids)}
+        self.payload_filter = PayloadFilter(self.size, self.ids, self.payloads, filter_fields)
+
+        logger.info(f'loaded {self.size} points from the local vector store {path}')
+
+    def _point(self, row: int, score: float | None = None):
+        if score is None:
+            return models.Record(id=self.ids[row], payload=self.payloads[row])
+        return models.ScoredPoint(id=self.ids[row], version=0, score=score, payload=self.payloads[row])
+
+    # payloads are already in memory, so they are returned whole whatever `with_payload` asks for
+    def search(self, vector, top_k=10, query_filter=None, with_payload=True, search_params=None):
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        mask = self.payload_filter.mask(query_filter)
+        rows = np.arange(self.size) if mask is None else np.flatnonzero(mask)
+        if len(rows) == 0:
+            return []
+
+        scores = self.vectors[rows] @ query if mask is not None else self.vectors @ query
+        top_k = min(top_k, len(rows))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [self._point(int(rows[index]), float(scores[index])) for index in top]
+
+    def scroll(self, query_filter=None, limit=10, with_payload=True):
+        mask = self.payload_filter.mask(query_filter)
+        rows = range(min(limit, self.size)) if mask is None else np.flatnonzero(mask)[:limit]
+        return [self._point(int(row)) for row in rows]
+
+    def retrieve(self, ids, with_vectors=False):
+        rows = [self._rows[str(point_id)] for point_id in ids if str(point_id) in self._rows]
+        # the vectors are stored normalized, which leaves cosine similarities unchanged
+        return [models.Record(id=self.ids[row], payload=self.payloads[row],
+                              vector=self.vectors[row].tolist() if with_vectors else None)
+                for row in rows]
+
+    @classmethod
+    def snapshot_from_qdrant(cls, client: QdrantClient, collection_name: str, path: str, batch_size: int = 256):
+        """Export all points of a Qdrant collection into a local vector store at `path`"""
+        os.makedirs(path, exist_ok=True)
+        size, dim, offset = 0, None, None
+        with open(os.path.join(path, cls.vectors_file), 'wb') as vectors, \
+                open(os.path.join(path, cls.points_file), 'w') as points:
+            while True:
+                records, offset = client.scroll(collection_name=collection_name,
+                                                limit=batch_size,
+                                                offset=offset,
+                                                with_payload=True,
+                                                with_vectors=True)
+                if records:
+                    batch = np.asarray([record.vector for record in records], dtype=np.float32)
+                    batch /= np.maximum(np.linalg.norm(batch, axis=1, keepdims=True), 1e-12)
+                    vectors.write(batch.tobytes())
+                    points.writelines(json.dumps({'id': record.id, 'payload': record.payload}, default=str) + '\n'
+                                      for record in records)
+                    size += len(records)
+                    dim = batch.shape[1]
+                if offset is None:
+                    break
+
+        if dim is None:
+            dim = client.get_collection(collection_name).config.params.vectors.size
+        with open(os.path.join(path, cls.meta_file), 'w') as meta:
+            json.dump({'dim': dim, 'size': size, 'collection_name': collection_name}, meta)
+
+        logger.info(f'exported {size} points of {collection_name} to {path}')
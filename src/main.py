@@ -1,68 +1,348 @@
-import json
+import argparse
+from functools import partial
+from typing import Dict
 
 from loguru import logger
 
 from controllers.api_controller import ApiController
-from controllers.qdrant_manager import QdrantManager
+from controllers.keyword_index import KeywordIndex
+from controllers.qdrant_manager import QdrantManager, create_qdrant_client
+from controllers.vector_store import LocalVectorStore
 from configs.configs import ConfigManager
+from utils.embedding_cache import EmbeddingCache
+from utils.index_checkpoint import IndexCheckpoint
+from utils.metrics import MetricsRegistry
 from utils.products_preprocessor import ProductsPreprocessor
+from utils.result_cache import CatalogVersion
+from utils.serving import serve, configure_torch_threads
+from utils.sharded_indexing import (UploadClient, in_shard, repartition_checkpoints, run_shards, shard_files,
+                                    shard_ids, shard_path)
+from utils.upload_pipeline import UploadPipeline
 from flask import Flask
 
 
-def index_products():
+def get_encoder_configs(role: str) -> Dict:
+    """Encoder configs of a `serving` or `indexing` process, each loading only the towers it needs"""
+    encoder_configs = dict(ConfigManager.get_config_manager().get_prop('encoder_configs') or {})
+    modes = {'serving': encoder_configs.pop('serving_mode', 'full'),
+             'indexing': encoder_configs.pop('indexing_mode', 'full')}
+    encoder_configs['mode'] = modes[role]
+    return encoder_configs
+
+
+def index_products(shard_index: int = 0, shards: int = 1, upload_queue=None, ack_queue=None, processes: int = 1):
+    """
+    Index the products of shard `shard_index` out of `shards` (the whole catalog by default).
+    Given the queues of a shared upload stage (see `run_shards`), the batches are uploaded by the parent
+    process and the cores are split between the `processes` indexing on this machine.
+    """
     config_manager = ConfigManager.get_config_manager()
     db_configs = config_manager.get_prop('qdrant_configs')
     job_configs = config_manager.get_prop('insertion_job_configs')
+    encoder_configs = get_encoder_configs('indexing')
+
+    if shards > 1:
+        prefix = f'[shard {shard_index}/{shards}] '
+        logger.configure(patcher=lambda record: record.update(message=prefix + record['message']))
+    if processes > 1:
+        configure_torch_threads(processes, job_configs.get('sharding_configs', {}).get('torch_threads'))
 
     qdrant_manager = QdrantManager.get_qdrant_manager(url=db_configs['db_url'],
                                                       api_key=db_configs['db_api_key'],
-                                                      collection_name=db_configs['product_collection'])
-
-    # load products json
-    data_path = job_configs['path_to_products']
-    with open(data_path, 'r') as json_file:
-        data = json.load(json_file)
+                                                      collection_name=db_configs['product_collection'],
+                                                      encoder_configs=encoder_configs,
+                                                      collection_configs=db_configs.get('collection_configs'),
+                                                      transport_configs=db_configs.get('transport_configs'),
+                                                      # the parent process indexes the keywords of worker shards
+                                                      keyword_index_configs=indexer_keyword_index_configs(shards)
+                                                      if upload_queue is None else None,
+                                                      text_index_configs=db_configs.get('text_index_configs'))
+    qdrant_manager.catalog_version = indexer_catalog_version()
 
+    # stream products from the json (or json lines) file
     product_preprocessor = ProductsPreprocessor()
-    product_preprocessor.process_products(data)
+    products = product_preprocessor.iter_products(job_configs['path_to_products'])
+    if shards > 1:
+        products = (product for product in products if in_shard(product.id, shard_index, shards))
+
+    # PIL is only imported by the commands downloading images
+    from utils.image_downloader import ImageDownloader
+
+    download_configs = dict(job_configs.get('download_configs', {}))
+    image_preprocessor = qdrant_manager.clip_encoder.image_preprocessor
+    if download_configs.pop('draft_decoding', False) and image_preprocessor is not None:
+        # large JPEGs are decoded at the smallest scale that still covers the model's input size
+        download_configs['draft_size'] = image_preprocessor.size
+    image_downloader = ImageDownloader(**download_configs)
+
+    embedding_cache = None
+    cache_configs = job_configs.get('embedding_cache_configs', {})
+    if cache_configs.get('enabled', False):
+        # every process writes a cache of its own and reads those of the other processes and shard layouts
+        cache_dir = shard_path(cache_configs['cache_dir'], shard_index, shards)
+        cache_kwargs = dict(model_name=qdrant_manager.clip_encoder.model_name,
+                            dim=qdrant_manager.clip_encoder.projection_dim,
+                            verify_content=cache_configs.get('verify_content', False))
+        fallbacks = [EmbeddingCache(cache_dir=other_dir, read_only=True, **cache_kwargs)
+                     for other_dir in shard_files(cache_configs['cache_dir']) if other_dir != cache_dir]
+        embedding_cache = EmbeddingCache(cache_dir=cache_dir, fallbacks=fallbacks, **cache_kwargs)
+
+    if upload_queue is not None:
+        upload_pipeline = UploadClient(shard_index, upload_queue, ack_queue)
+    else:
+        upload_pipeline = UploadPipeline(qdrant_manager.client,
+                                         qdrant_manager.collection_name,
+                                         **job_configs.get('upload_configs', {}))
+
+    insert_kwargs = dict(insertion_batch_size=job_configs['insertion_batch_size'],
+                         image_downloader=image_downloader,
+                         prefetch_batches=job_configs.get('prefetch_batches', 2),
+                         inference_batch_size=job_configs.get('inference_batch_size', 32),
+                         embedding_cache=embedding_cache,
+                         upload_pipeline=upload_pipeline, )
+    try:
+        if job_configs.get('incremental', False):
+            checkpoint = IndexCheckpoint(shard_path(job_configs['checkpoint_path'], shard_index, shards))
+            qdrant_manager.sync_products(products=products,
+                                         checkpoint=checkpoint,
+                                         **insert_kwargs)
+        else:
+            qdrant_manager.insert_batch(products=products,
+                                        start_offset=job_configs.get('start_offset', 0),
+                                        **insert_kwargs)
+    finally:
+        try:
+            upload_pipeline.close()
+        finally:
+            image_downloader.close()
+            qdrant_manager.save_keyword_index()
+            if qdrant_manager.catalog_modified:
+                # once more after the barrier, every uploaded point is searchable by now
+                qdrant_manager.catalog_changed()
+            textfile = metrics_textfile()
+            if textfile is not None:
+                write_indexer_metrics(shard_path(textfile, shard_index, shards))
+
+
+def index_products_sharded(shards: int = 1, shard_index: int = 0, processes: int | None = None):
+    """
+    Index the products of machine `shard_index` out of `shards` in `processes` worker processes,
+    each running its own encoder, with the uploads of all of them going through this process.
+    """
+    config_manager = ConfigManager.get_config_manager()
+    db_configs = config_manager.get_prop('qdrant_configs')
+    job_configs = config_manager.get_prop('insertion_job_configs')
+    processes = processes or job_configs.get('sharding_configs', {}).get('processes', 1)
+
+    if job_configs.get('incremental', False):
+        repartition_checkpoints(job_configs['checkpoint_path'], shards=shard_ids(shards, shard_index, processes),
+                                total_shards=shards * processes)
+
+    if processes == 1:
+        index_products(shard_index, shards)
+        return
+
+    keyword_index = None
+    keyword_index_configs = indexer_keyword_index_configs(shards)
+    if keyword_index_configs is not None:
+        keyword_index = KeywordIndex.from_configs(keyword_index_configs, db_configs.get('text_index_configs'))
+    # payload updates and deletions of incremental runs happen in the workers, the index is rebuilt after them
+    incremental = job_configs.get('incremental', False)
+
+    # the workers bump the version whenever they write payload updates or deletions
+    catalog_version = indexer_catalog_version()
+    version_before = catalog_version.get() if catalog_version is not None else None
+
+    upload_configs = job_configs.get('upload_configs', {})
+    upload_pipeline = UploadPipeline(create_qdrant_client(db_configs['db_url'], db_configs['db_api_key'],
+                                                          db_configs.get('transport_configs')),
+                                     db_configs['product_collection'],
+                                     **upload_configs)
+    try:
+        run_shards(partial(index_products, processes=processes),
+                   shards=shard_ids(shards, shard_index, processes),
+                   total_shards=shards * processes,
+                   upload_pipeline=upload_pipeline,
+                   max_pending_batches=upload_configs.get('max_pending_batches', 8),
+                   on_uploaded=partial(index_keyword_points, keyword_index)
+                   if keyword_index is not None and not incremental else None)
+    finally:
+        catalog_version = indexer_catalog_version()
+        workers_wrote = catalog_version is None or catalog_version.get() != version_before
+        keyword_index_saved = False
+        if keyword_index is not None:
+            if incremental:
+                if upload_pipeline.uploaded_points or workers_wrote:
+                    keyword_index_saved = keyword_index.build_from_qdrant(upload_pipeline.client,
+                                                                          db_configs['product_collection'])
+            else:
+                keyword_index_saved = keyword_index.save()
+        if catalog_version is not None and (upload_pipeline.uploaded_points or keyword_index_saved):
+            catalog_version.bump()
+        # the upload stage runs in this process, the workers write the metrics of their own stages
+        textfile = metrics_textfile()
+        if textfile is not None:
+            write_indexer_metrics(textfile)
+
+
+def indexer_keyword_index_configs(shards: int) -> Dict | None:
+    """Configs of the keyword index the indexing job updates, None when it does not"""
+    db_configs = ConfigManager.get_config_manager().get_prop('qdrant_configs')
+    keyword_index_configs = db_configs.get('keyword_index_configs') or {}
+    if not keyword_index_configs.get('enabled', False):
+        return None
+    if shards > 1:
+        logger.warning('the keyword index of a single shard would miss the rest of the catalog, '
+                       'run `main.py build-keyword-index` once every shard is indexed')
+        return None
+    return keyword_index_configs
+
+
+def index_keyword_points(keyword_index: KeywordIndex, points):
+    keyword_index.upsert((point.id, point.payload) for point in points)
+
+
+def indexer_catalog_version() -> CatalogVersion | None:
+    """Catalog version the indexing job bumps, invalidating the result pages cached by the API"""
+    result_cache_configs = ConfigManager.get_config_manager().get_prop('result_cache_configs') or {}
+    if not result_cache_configs.get('enabled', False):
+        return None
+    return CatalogVersion.from_configs(result_cache_configs)
+
+
+def metrics_textfile() -> str | None:
+    return (ConfigManager.get_config_manager().get_prop('metrics_configs') or {}).get('indexer_textfile')
+
+
+def write_indexer_metrics(path: str):
+    MetricsRegistry.get_registry().write_textfile(path)
+    logger.info(f'indexer metrics written to {path}')
+
+
+def replay_dead_letters():
+    config_manager = ConfigManager.get_config_manager()
+    db_configs = config_manager.get_prop('qdrant_configs')
+    job_configs = config_manager.get_prop('insertion_job_configs')
 
-    qdrant_manager.insert_batch(products=product_preprocessor.products,
-                                insertion_batch_size=job_configs['insertion_batch_size'], )
+    client = create_qdrant_client(db_configs['db_url'], db_configs['db_api_key'], db_configs.get('transport_configs'))
+    upload_pipeline = UploadPipeline(client, db_configs['product_collection'], **job_configs.get('upload_configs', {}))
+    upload_pipeline.replay()
+    catalog_version = indexer_catalog_version()
+    if catalog_version is not None and upload_pipeline.uploaded_points:
+        catalog_version.bump()
 
 
 def create_full_text_index():
     config_manager = ConfigManager.get_config_manager()
     db_configs = config_manager.get_prop('qdrant_configs')
+    encoder_configs = get_encoder_configs('indexing')
 
     qdrant_manager = QdrantManager.get_qdrant_manager(url=db_configs['db_url'],
                                                       api_key=db_configs['db_api_key'],
-                                                      collection_name=db_configs['product_collection'])
+                                                      collection_name=db_configs['product_collection'],
+                                                      encoder_configs=encoder_configs,
+                                                      collection_configs=db_configs.get('collection_configs'),
+                                                      transport_configs=db_configs.get('transport_configs'))
 
     keyword_index_configs = db_configs.get('text_index_configs')
     qdrant_manager.index_keywords(field_name=keyword_index_configs.pop('field_name'),
                                   params=keyword_index_configs)
 
 
+def build_keyword_index():
+    config_manager = ConfigManager.get_config_manager()
+    db_configs = config_manager.get_prop('qdrant_configs')
+    client = create_qdrant_client(db_configs['db_url'], db_configs['db_api_key'], db_configs.get('transport_configs'))
+    keyword_index = KeywordIndex.from_configs(db_configs['keyword_index_configs'], db_configs.get('text_index_configs'))
+    saved = keyword_index.build_from_qdrant(client, db_configs['product_collection'])
+    # cached keyword pages were ranked by the previous index
+    catalog_version = indexer_catalog_version()
+    if catalog_version is not None and saved:
+        catalog_version.bump()
+
+
+def tune_collection():
+    config_manager = ConfigManager.get_config_manager()
+    db_configs = config_manager.get_prop('qdrant_configs')
+    encoder_configs = get_encoder_configs('indexing')
+
+    qdrant_manager = QdrantManager.get_qdrant_manager(url=db_configs['db_url'],
+                                                      api_key=db_configs['db_api_key'],
+                                                      collection_name=db_configs['product_collection'],
+                                                      encoder_configs=encoder_configs,
+                                                      collection_configs=db_configs.get('collection_configs'),
+                                                      transport_configs=db_configs.get('transport_configs'))
+    qdrant_manager.apply_collection_profile()
+
+
+def snapshot_local_store():
+    config_manager = ConfigManager.get_config_manager()
+    db_configs = config_manager.get_prop('qdrant_configs')
+    client = create_qdrant_client(db_configs['db_url'], db_configs['db_api_key'], db_configs.get('transport_configs'))
+    LocalVectorStore.snapshot_from_qdrant(client,
+                                          collection_name=db_configs['product_collection'],
+                                          path=db_configs['local_store_configs']['path'])
+
+
 def start_application():
     config_manager = ConfigManager.get_config_manager()
     qdrant_config = config_manager.get_prop('qdrant_configs')
     server_config = config_manager.get_prop('server_configs')
     hybrid_search_configs = config_manager.get_prop('hybrid_search_configs')
+    text_cache_configs = config_manager.get_prop('text_cache_configs')
+    inference_scheduler_configs = config_manager.get_prop('inference_scheduler_configs')
+    metrics_configs = config_manager.get_prop('metrics_configs')
+    batch_search_configs = config_manager.get_prop('batch_search_configs')
+    image_search_configs = config_manager.get_prop('image_search_configs')
+    result_cache_configs = config_manager.get_prop('result_cache_configs')
+    encoder_configs = get_encoder_configs('serving')
 
     app = Flask(__name__)
     api_controller = ApiController(qdrant_configs=qdrant_config,
-                                   hybrid_search_configs=hybrid_search_configs)
+                                   hybrid_search_configs=hybrid_search_configs,
+                                   text_cache_configs=text_cache_configs,
+                                   inference_scheduler_configs=inference_scheduler_configs,
+                                   encoder_configs=encoder_configs,
+                                   metrics_configs=metrics_configs,
+                                   batch_search_configs=batch_search_configs,
+                                   image_search_configs=image_search_configs,
+                                   result_cache_configs=result_cache_configs)
 
     app.add_url_rule('/search',
                      'semantic_search',
                      view_func=api_controller.search,
                      methods=['GET'])
 
+    app.add_url_rule('/search/batch',
+                     'batch_search',
+                     view_func=api_controller.search_batch,
+                     methods=['POST'])
+
+    app.add_url_rule('/search/image',
+                     'image_search',
+                     view_func=api_controller.search_image,
+                     methods=['POST'])
+
+    app.add_url_rule('/similar/<int:product_id>',
+                     'similar_products',
+                     view_func=api_controller.similar,
+                     methods=['GET'])
+
     app.add_url_rule('/index',
                      'index',
                      view_func=api_controller.index,
                      methods=['GET'])
 
+    app.add_url_rule('/stats',
+                     'stats',
+                     view_func=api_controller.stats,
+                     methods=['GET'])
+
+    app.add_url_rule('/metrics',
+                     'metrics',
+                     view_func=api_controller.metrics,
+                     methods=['GET'])
+
     app.add_url_rule('/is_ready',
                      'is_ready',
                      view_func=api_controller.is_ready,
@@ -71,13 +351,53 @@ def start_application():
     return app, server_config
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='CLIP image search backend')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='run the search API (default)')
+    serve_parser.add_argument('--backend', choices=['gunicorn', 'waitress', 'flask'],
+                              help='server to run the API with, overrides server_configs.backend')
+    serve_parser.add_argument('--workers', type=int, help='number of worker processes (gunicorn)')
+    serve_parser.add_argument('--threads', type=int, help='number of threads per worker')
+
+    index_parser = subparsers.add_parser('index', help='index the products catalog')
+    index_parser.add_argument('--processes', type=int,
+                              help='worker processes encoding the catalog, overrides sharding_configs.processes')
+    index_parser.add_argument('--shards', type=int, default=1, help='number of machines the catalog is split across')
+    index_parser.add_argument('--shard-index', type=int, default=0, help='shard of the catalog this machine indexes')
+    subparsers.add_parser('replay-dead-letters', help='upload the batches the indexing job failed to upload')
+    subparsers.add_parser('create-text-index', help='create the full text index of the keyword search')
+    subparsers.add_parser('build-keyword-index', help='rebuild the BM25 keyword index from the collection')
+    subparsers.add_parser('tune-collection', help='apply the collection profile and filter indexes to the collection')
+    subparsers.add_parser('snapshot-local-store', help='export the collection for the local vector store')
+
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    app, server_configs = start_application()
-    app.run(host='0.0.0.0', port=server_configs['port'])
-    # from waitress import serve
-    #
-    # logger.info('Starting server...')
-    #
-    # serve(app, host='0.0.0.0',
-    #       port=server_configs['port'],
-    #       threads=2)
+    args = parse_args()
+
+    if args.command == 'index':
+        index_products_sharded(shards=args.shards, shard_index=args.shard_index, processes=args.processes)
+    elif args.command == 'replay-dead-letters':
+        replay_dead_letters()
+    elif args.command == 'create-text-index':
+        create_full_text_index()
+    elif args.command == 'build-keyword-index':
+        build_keyword_index()
+    elif args.command == 'tune-collection':
+        tune_collection()
+    elif args.command == 'snapshot-local-store':
+        snapshot_local_store()
+    else:
+        server_configs = ConfigManager.get_config_manager().get_prop('server_configs')
+        for key, value in (('backend', getattr(args, 'backend', None)),
+                           ('num_workers', getattr(args, 'workers', None)),
+                           ('threads', getattr(args, 'threads', None))):
+            if value is not None:
+                server_configs[key] = value
+
+        serve(lambda: start_application()[0],
+              server_configs,
+              post_fork=lambda: QdrantManager.qdrant_manager.reconnect())
@@ -48,8 +48,12 @@ class Product(BaseModel):
     @computed_field(return_type=str)
     @property
     def uuid(self):
+        return self.generate_uuid(self.id)
+
+    @staticmethod
+    def generate_uuid(product_id: int) -> str:
         """Generate a deterministic UUID4 based on the product ID"""
-        generated_uuid = str(uuid.UUID(int=self.id, version=4))
+        generated_uuid = str(uuid.UUID(int=product_id, version=4))
 
         return generated_uuid
 
@@ -72,16 +76,50 @@ class Product(BaseModel):
             'images': self.images,
         }
 
-    def to_vector_record(self, embedding: List[float]) -> Dict[str, Any]:
-        """Convert product to vector record format"""
+    def to_payload(self) -> Dict[str, Any]:
         payload = self.dict().copy()
         payload.pop('uuid')
 
-        payload = {k: v for k, v in payload.items()
-                   if v is not None}
+        return {k: v for k, v in payload.items()
+                if v is not None}
 
+    def to_vector_record(self, embedding: List[float]) -> Dict[str, Any]:
+        """Convert product to vector record format"""
         return {
             'id': self.uuid,
             'vector': embedding,
-            'payload': payload
+            'payload': self.to_payload()
+        }
+
+
+class ProductHit:
+    """
+    Search hit built straight from a Qdrant payload, without re-validating it as a `Product`.
+    Only `payload_fields` are requested from Qdrant for it.
+    """
+    __slots__ = ('uuid', 'name', 'current_price', 'currency', 'link', 'images')
+    payload_fields = ['name', 'current_price', 'currency', 'link', 'images']
+
+    def __init__(self, uuid: str, name: str, current_price: float, currency: str, link: str, images: List[str]):
+        self.uuid = uuid
+        self.name = name
+        self.current_price = current_price
+        self.currency = currency
+        self.link = link
+        self.images = images
+
+    @classmethod
+    def from_point(cls, point) -> 'ProductHit':
+        payload = point.payload
+        return cls(str(point.id), payload.get('name'), payload.get('current_price'), payload.get('currency'),
+                   payload.get('link'), payload.get('images'))
+
+    def to_response_obj(self):
+        return {
+            'id': self.uuid,
+            'name': self.name,
+            'price': self.current_price,
+            'currency': self.currency,
+            'link': self.link,
+            'images': self.images,
         }
@@ -1,3 +1,4 @@
+import json
 from typing import Optional
 from pydantic import BaseModel, Field, field_validator
 from enum import IntEnum
@@ -11,12 +12,13 @@ class RetrievalType(IntEnum):
     keyword = 2
 
 
-class Query(BaseModel):
-    """Query model with validation"""
-    query: str = Field(..., min_length=1, max_length=255)
-    retrieval_type: Optional[RetrievalType] = Field(default=RetrievalType.hybrid)
+class SearchOptions(BaseModel):
+    """Result size, search-time tuning and filters shared by every kind of search"""
     size: Optional[int] = Field(5, ge=1, le=255)
-    filters: Optional[dict] = Field({})
+    # search-time tuning, defaults to the configured search_params
+    hnsw_ef: Optional[int] = Field(None, ge=1, le=4096)
+    oversampling: Optional[float] = Field(None, ge=1, le=16)
+    filters: Optional[dict] = Field({}, validate_default=True)
 
     @field_validator('filters')
     def validate_filters(cls, field_value):
@@ -29,3 +31,18 @@ class Query(BaseModel):
         else:
             filters = None
         return filters
+
+
+class Query(SearchOptions):
+    """Query model with validation"""
+    query: str = Field(..., min_length=1, max_length=255)
+    retrieval_type: Optional[RetrievalType] = Field(default=RetrievalType.hybrid)
+    # results skipped before the page of `size`
+    offset: Optional[int] = Field(0, ge=0, le=1000)
+
+    def cache_key(self) -> str:
+        """Key of the results of the query, equal for queries differing only in case, spacing or filter order"""
+        filters = sorted((condition.key, condition.match.value) for condition in self.filters.must) \
+            if self.filters is not None else []
+        return json.dumps([' '.join(self.query.lower().split()), int(self.retrieval_type), self.size,
+                           self.offset, self.hnsw_ef, self.oversampling, filters], default=str)
@@ -0,0 +1,26 @@
+import json
+
+from utils.products_preprocessor import ProductsPreprocessor
+
+
+def product(product_id):
+    return {'id': product_id, 'name': f'shirt {product_id}', 'current_price': 10.0, 'currency': 'USD',
+            'images': [f'https://example.com/{product_id}.jpg'], 'code': f'code-{product_id}',
+            'link': f'https://example.com/{product_id}'}
+
+
+def test_non_object_records_are_skipped(tmp_path):
+    records = [product(1), 5, 'shirt', None, [product(2)], {'id': 'invalid'}, product(3)]
+    path = tmp_path / 'products.json'
+    path.write_text(json.dumps(records))
+
+    products = ProductsPreprocessor().iter_products(str(path), read_size=16)
+
+    assert [product.id for product in products] == [1, 3]
+
+
+def test_non_object_lines_are_skipped(tmp_path):
+    path = tmp_path / 'products.jsonl'
+    path.write_text('\n'.join(json.dumps(record) for record in [product(1), 'shirt', 7, product(2)]))
+
+    assert [product.id for product in ProductsPreprocessor().iter_products(str(path))] == [1, 2]
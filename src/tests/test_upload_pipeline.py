@@ -0,0 +1,91 @@
+import queue
+from threading import Thread
+
+import pytest
+from qdrant_client import models
+
+from utils.sharded_indexing import UploadClient
+from utils.upload_pipeline import UploadPipeline
+
+
+class RecordingClient:
+    def __init__(self):
+        self.upserted = []
+
+    def upsert(self, collection_name, points, wait):
+        self.upserted.extend(point.id for point in points)
+
+
+def batch(point_id):
+    return [models.PointStruct(id=point_id, vector=[0.0], payload={})]
+
+
+def run_with_timeout(target, timeout=10):
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f'{target.__name__} blocked'
+    return errors
+
+
+def test_failing_callbacks_keep_the_workers_running():
+    client = RecordingClient()
+    pipeline = UploadPipeline(client, 'products', num_workers=2, max_pending_batches=1)
+    recorded = []
+
+    def on_uploaded(point_id):
+        if point_id < 4:
+            raise OSError('no space left on device')
+        recorded.append(point_id)
+
+    def submit_all():
+        for point_id in range(10):
+            pipeline.submit(batch(point_id), on_uploaded=lambda point_id=point_id: on_uploaded(point_id))
+
+    assert run_with_timeout(submit_all) == []
+    errors = run_with_timeout(pipeline.close)
+
+    assert sorted(set(client.upserted)) == list(range(10))
+    assert sorted(recorded) == list(range(4, 10))
+    assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
+    assert isinstance(errors[0].__cause__, OSError)
+
+
+def test_failing_callbacks_are_raised_by_drain():
+    pipeline = UploadPipeline(RecordingClient(), 'products', num_workers=1)
+    pipeline.submit(batch(0), on_uploaded=lambda: 1 / 0)
+
+    with pytest.raises(RuntimeError):
+        pipeline.drain()
+    with pytest.raises(RuntimeError):
+        pipeline.close()
+
+
+def test_failing_callbacks_keep_the_ack_reader_running():
+    upload_queue, ack_queue = queue.Queue(), queue.Queue()
+    upload_client = UploadClient(0, upload_queue, ack_queue)
+    recorded = []
+
+    def on_uploaded(point_id):
+        if point_id == 0:
+            raise OSError('no space left on device')
+        recorded.append(point_id)
+
+    for point_id in range(3):
+        upload_client.submit(batch(point_id), on_uploaded=lambda point_id=point_id: on_uploaded(point_id))
+    while not upload_queue.empty():
+        _, batch_id, _ = upload_queue.get()
+        ack_queue.put((batch_id, True))
+
+    errors = run_with_timeout(upload_client.close)
+
+    assert recorded == [1, 2]
+    assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
@@ -1,26 +1,106 @@
-from typing import Union, List
-import torch
-from PIL import Image
-import requests
-from io import BytesIO
-from transformers import CLIPProcessor, CLIPModel
+from typing import Union, List, Optional, Dict, TYPE_CHECKING
 import numpy as np
 
+from utils.embedding_cache import EmbeddingCache
+from utils.lru_cache import LRUCache
+from utils.metrics import encoder_stage
+
+if TYPE_CHECKING:
+    from PIL import Image
+    from utils.image_downloader import ImageDownloader
+
+# towers loaded in every mode of the encoder
+TEXT_MODES = ('full', 'text')
+IMAGE_MODES = ('full', 'image')
+
 
 class CLIPEncoder:
-    def __init__(self, model_name: str = "openai/clip-vit-base-patch32"):
+    def __init__(self,
+                 model_name: str = "openai/clip-vit-base-patch32",
+                 image_downloader: Optional['ImageDownloader'] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 text_cache: Optional[LRUCache] = None,
+                 backend: str = 'torch',
+                 backend_configs: Optional[Dict] = None,
+                 mode: str = 'full',
+                 fast_preprocessing: bool = True):
         """
         Initialize the CLIP encoder with specified model.
 
         Args:
             model_name (str): Name of the CLIP model to use
+            image_downloader (ImageDownloader): Downloader used to fetch images from URLs
+            embedding_cache (EmbeddingCache): Cache consulted before downloading and encoding image URLs
+            text_cache (LRUCache): Cache of text embeddings keyed by the normalized text
+            backend (str): Inference backend running the towers, `torch` or `onnx`
+            backend_configs (Dict): Options of the backend, e.g. `quantize` for onnx
+            mode (str): Towers to load, `full`, `text` (search) or `image` (indexing)
+            fast_preprocessing (bool): Preprocess images with the batched NumPy `ImagePreprocessor`
+                instead of `CLIPImageProcessor`, and let the default downloader decode JPEGs at reduced scale
         """
+        # heavy dependencies are only imported once an encoder is actually built
+        import torch
+        from transformers import (CLIPConfig, CLIPModel, CLIPTextModelWithProjection, CLIPVisionModelWithProjection,
+                                  CLIPTokenizerFast)
+        from utils.encoder_backends import create_backend
+
+        if mode not in TEXT_MODES + IMAGE_MODES:
+            raise ValueError(f'Unsupported encoder mode {mode}')
+
+        self.model_name = model_name
+        self.mode = mode
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = CLIPModel.from_pretrained(model_name).to(self.device)
-        self.processor = CLIPProcessor.from_pretrained(model_name)
+        if mode == 'full':
+            self.model = CLIPModel.from_pretrained(model_name)
+        else:
+            # load a single tower of the full checkpoint, its config doesn't carry the projection size
+            config = CLIPConfig.from_pretrained(model_name)
+            tower_config = config.text_config if mode == 'text' else config.vision_config
+            tower_config.projection_dim = config.projection_dim
+            model_class = CLIPTextModelWithProjection if mode == 'text' else CLIPVisionModelWithProjection
+            self.model = model_class.from_pretrained(model_name, config=tower_config)
+        self.model = self.model.to(self.device).eval()
+        self.tokenizer = CLIPTokenizerFast.from_pretrained(model_name) if mode in TEXT_MODES else None
+        self.image_processor = None
+        self.image_preprocessor = None
+        if mode in IMAGE_MODES:
+            # image processing needs PIL, which the text tower doesn't
+            from transformers import CLIPImageProcessor
+            from utils.image_preprocessing import ImagePreprocessor
 
-    @staticmethod
-    def _load_image_from_url(url: str) -> Image.Image:
+            self.image_processor = CLIPImageProcessor.from_pretrained(model_name)
+            if fast_preprocessing:
+                self.image_preprocessor = ImagePreprocessor.from_image_processor(self.image_processor)
+        self.backend = create_backend(backend, self.model, model_name, self.device, **(backend_configs or {}))
+        self._image_downloader = image_downloader
+        self.embedding_cache = embedding_cache
+        self.text_cache = text_cache
+
+    @property
+    def projection_dim(self) -> int:
+        if self.mode == 'full':
+            return self.model.config.projection_dim
+        if self.mode == 'text':
+            return self.model.text_projection.out_features
+        return self.model.visual_projection.out_features
+
+    @property
+    def image_downloader(self) -> 'ImageDownloader':
+        if self._image_downloader is None:
+            from utils.image_downloader import ImageDownloader
+            draft_size = self.image_preprocessor.size if self.image_preprocessor is not None else None
+            self._image_downloader = ImageDownloader(draft_size=draft_size)
+        return self._image_downloader
+
+    @property
+    def has_image_tower(self) -> bool:
+        return self.mode in IMAGE_MODES
+
+    def _require(self, modes, tower: str):
+        if self.mode not in modes:
+            raise ValueError(f'The {tower} tower is not loaded in `{self.mode}` mode of the encoder')
+
+    def _load_image_from_url(self, url: str) -> 'Image.Image':
         """
         Load an image from a URL.
 
@@ -33,15 +113,12 @@ class CLIPEncoder:
         Raises:
             ValueError: If image cannot be loaded from URL
         """
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            return Image.open(BytesIO(response.content)).convert('RGB')
-        except Exception as e:
-            raise ValueError(f"Failed to load image from URL: {str(e)}")
+        return self.image_downloader.load(url)
 
     @staticmethod
-    def _load_image_from_path(path: Union[str, Image.Image]) -> Image.Image:
+    def _load_image_from_path(path: Union[str, 'Image.Image']) -> 'Image.Image':
+        from PIL import Image
+
         if isinstance(path, str):
             img = Image.open(path).convert('RGB')
         elif isinstance(path, Image.Image):
@@ -50,6 +127,12 @@ class CLIPEncoder:
             raise ValueError(f"Expected path or PIL.Image as the input but get {str(path)}")
         return img
 
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        # the CLIP tokenizer lower-cases and collapses whitespace anyway,
+        # so normalized variants of a query share the same embedding
+        return ' '.join(text.lower().split())
+
     def encode_text(self, text: str) -> List[float]:
         """
         Encode text using CLIP model.
@@ -60,15 +143,56 @@ class CLIPEncoder:
         Returns:
             np.ndarray: Text embedding
         """
-        inputs = self.processor(text=text, return_tensors="pt", padding=True)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        return self.encode_texts([text])[0]
+
+    def encode_texts(self, texts: List[str], lookup_cache: bool = True) -> List[List[float]]:
+        """
+        Encode texts in a single padded batch, serving cached texts without inference.
+
+        Args:
+            texts (List[str]): Input texts to encode
+            lookup_cache (bool): Whether to look the texts up in the cache, new embeddings are cached either way
+
+        Returns:
+            List[List[float]]: Text embeddings in the order of the input texts
+        """
+        if self.text_cache is None:
+            return self._encode_texts(texts)
+
+        texts = [self.normalize_text(text) for text in texts]
+        text_embeddings = {}
+        for text in texts:
+            if text not in text_embeddings:
+                text_embeddings[text] = self.text_cache.get(text) if lookup_cache else None
+
+        missing_texts = [text for text, text_embedding in text_embeddings.items() if text_embedding is None]
+        if missing_texts:
+            for text, text_embedding in zip(missing_texts, self._encode_texts(missing_texts)):
+                self.text_cache.put(text, text_embedding)
+                text_embeddings[text] = text_embedding
+
+        return [text_embeddings[text] for text in texts]
+
+    def _encode_texts(self, texts: List[str]) -> List[List[float]]:
+        self._require(TEXT_MODES, 'text')
+        if not texts:
+            return []
+        with encoder_stage('tokenize'):
+            inputs = self.tokenizer(texts, return_tensors="np", padding=True)
+        with encoder_stage('text_forward'):
+            return self.backend.text_features(dict(inputs)).tolist()
 
-        with torch.no_grad():
-            text_features = self.model.get_text_features(**inputs)
+    def _preprocess_images(self, images: List['Image.Image']) -> np.ndarray:
+        with encoder_stage('image_preprocess'):
+            if self.image_preprocessor is not None:
+                return self.image_preprocessor(images)
+            return self.image_processor(images=images, return_tensors="np")['pixel_values']
 
-        return text_features[0].cpu().tolist()
+    def _image_features(self, pixel_values: np.ndarray) -> np.ndarray:
+        with encoder_stage('image_forward'):
+            return self.backend.image_features(pixel_values)
 
-    def encode_image(self, images: List[Union[str, Image.Image]], is_url: bool = True) -> List[float]:
+    def encode_image(self, images: List[Union[str, 'Image.Image']], is_url: bool = True) -> List[float]:
         """
         Encode image using CLIP model.
 
@@ -82,27 +206,69 @@ class CLIPEncoder:
         Raises:
             ValueError: If image cannot be processed
         """
+        self._require(IMAGE_MODES, 'image')
         try:
             # Handle image input
             if is_url:
                 for image in images:
                     if not isinstance(image, str):
                         raise ValueError("URL must be a string")
+                if self.embedding_cache is not None:
+                    return self._encode_urls_with_cache(images).mean(axis=0).tolist()
                 input_images = list(map(self._load_image_from_url, images))
             else:
                 input_images = list(map(self._load_image_from_path, images))
 
-            # Process image
-            inputs = self.processor(images=input_images, return_tensors="pt", padding=True)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-
             # Generate embedding
-            with torch.no_grad():
-                image_features = self.model.get_image_features(**inputs)
+            image_features = self._image_features(self._preprocess_images(input_images))
 
             # because we use `dot products`/`cosine` at the end
             # it would make sense to use mean of the vectors as the representor
-            return image_features.mean(axis=0).cpu().tolist()
+            return image_features.mean(axis=0).tolist()
 
         except Exception as e:
             raise ValueError(f"Failed to process image: {str(e)}")
+
+    def _encode_urls_with_cache(self, urls: List[str]) -> np.ndarray:
+        cache = self.embedding_cache
+        embeddings = []
+        for url in urls:
+            embedding = None if cache.verify_content else cache.get(url)
+            if embedding is None:
+                image, image_hash = self.image_downloader.load_with_hash(url)
+                embedding = cache.get(url, image_hash) if cache.verify_content else None
+                if embedding is None:
+                    embedding = self.encode_images([image])[0]
+                    cache.put(url, image_hash, embedding)
+            embeddings.append(embedding)
+
+        cache.flush()
+        return np.stack(embeddings)
+
+    def encode_images(self, images: List['Image.Image'], batch_size: int = 32) -> np.ndarray:
+        """
+        Encode images in fixed-size inference batches.
+
+        Args:
+            images (List[Image.Image]): Input PIL Images
+            batch_size (int): Number of images per forward pass
+
+        Returns:
+            np.ndarray: Image embeddings with shape (len(images), projection_dim)
+
+        Raises:
+            ValueError: If images cannot be processed
+        """
+        self._require(IMAGE_MODES, 'image')
+        try:
+            image_features = []
+            for batch_start in range(0, len(images), batch_size):
+                pixel_values = self._preprocess_images(images[batch_start:batch_start + batch_size])
+                image_features.append(self._image_features(pixel_values))
+
+            if not image_features:
+                return np.empty((0, self.projection_dim), dtype=np.float32)
+            return np.concatenate(image_features)
+
+        except Exception as e:
+            raise ValueError(f"Failed to process images: {str(e)}")
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import re
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent image embedding cache keyed by image URL, content hash and model name.
+
+    Embeddings live in a memory-mapped float32 matrix (`embeddings.f32`) and the keys in an
+    append-only index file (`keys.tsv`) with one `url_key<TAB>content_hash<TAB>row` line per entry.
+    Every model gets its own sub-directory, so switching models never serves stale vectors.
+    Misses are looked up in the read-only `fallbacks`, e.g. the caches of the other indexing processes.
+    """
+    embeddings_file = 'embeddings.f32'
+    keys_file = 'keys.tsv'
+
+    def __init__(self,
+                 cache_dir: str,
+                 model_name: str,
+                 dim: int,
+                 verify_content: bool = False,
+                 initial_capacity: int = 1024,
+                 read_only: bool = False,
+                 fallbacks: Sequence['EmbeddingCache'] = ()):
+        """
+        Args:
+            cache_dir (str): Root directory of the cache
+            model_name (str): Name of the model the embeddings were produced with
+            dim (int): Dimension of the embeddings
+            verify_content (bool): Only serve an entry if the downloaded image bytes still hash
+                to the cached content hash. Without it a known URL skips the download entirely.
+            initial_capacity (int): Number of rows allocated when the cache is created
+            read_only (bool): Only serve the entries flushed when the cache is opened
+            fallbacks (Sequence[EmbeddingCache]): Caches looked up on a miss
+        """
+        self.model_name = model_name
+        self.dim = dim
+        self.verify_content = verify_content
+        self.path = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name))
+        self.read_only = read_only
+        self.fallbacks = list(fallbacks)
+        if not read_only:
+            os.makedirs(self.path, exist_ok=True)
+
+        self._lock = Lock()
+        self._index: Dict[str, Tuple[str, int]] = {}
+        self._pending_keys: List[str] = []
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._load_index()
+        if read_only:
+            # rows are only ever appended, the flushed ones stay valid while another process writes
+            self.capacity = self._size
+            self.embeddings = np.memmap(os.path.join(self.path, self.embeddings_file), dtype=np.float32, mode='r',
+                                        shape=(self._size, dim)) if self._size else np.empty((0, dim), np.float32)
+        else:
+            self._open_embeddings(max(initial_capacity, self._size))
+
+    def _url_key(self, url: str) -> str:
+        return hashlib.sha1(f'{self.model_name}\n{url}'.encode('utf-8')).hexdigest()
+
+    def _load_index(self):
+        keys_path = os.path.join(self.path, self.keys_file)
+        embeddings_path = os.path.join(self.path, self.embeddings_file)
+        if not os.path.exists(keys_path):
+            return
+
+        stored_rows = os.path.getsize(embeddings_path) // (4 * self.dim) if os.path.exists(embeddings_path) else 0
+        with open(keys_path, 'r') as keys:
+            for line in keys:
+                try:
+                    url_key, stored_hash, row = line.rstrip('\n').split('\t')
+                    row = int(row)
+                except ValueError:
+                    # partially written line of an interrupted run
+                    continue
+                if row < stored_rows:
+                    self._index[url_key] = (stored_hash, row)
+                    self._size = max(self._size, row + 1)
+
+        logger.info(f'loaded {len(self._index)} cached embeddings from {self.path}')
+
+    def _open_embeddings(self, capacity: int):
+        embeddings_path = os.path.join(self.path, self.embeddings_file)
+        with open(embeddings_path, 'ab') as embeddings:
+            if embeddings.tell() < capacity * 4 * self.dim:
+                embeddings.truncate(capacity * 4 * self.dim)
+        self.capacity = capacity
+        self.embeddings = np.memmap(embeddings_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def get(self, url: str, content_hash: Optional[str] = None) -> Optional[np.ndarray]:
+        """
+        Return the cached embedding of an image, or None on a miss.
+
+        Args:
+            url (str): URL of the image
+            content_hash (str): Hash of the image bytes; if given, the entry must match it
+        """
+        embedding = self._lookup(url, content_hash)
+        for fallback in self.fallbacks:
+            if embedding is not None:
+                break
+            embedding = fallback._lookup(url, content_hash)
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return embedding
+
+    def _lookup(self, url: str, content_hash: Optional[str] = None) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._index.get(self._url_key(url))
+            if entry is None or (content_hash is not None and entry[0] != content_hash):
+                return None
+            return np.array(self.embeddings[entry[1]])
+
+    def put(self, url: str, content_hash: str, embedding: np.ndarray):
+        if self.read_only:
+            raise ValueError(f'the embedding cache {self.path} is read-only')
+        with self._lock:
+            if self._size >= self.capacity:
+                self.embeddings.flush()
+                self._open_embeddings(self.capacity * 2)
+
+            row = self._size
+            self._size += 1
+            self.embeddings[row] = embedding
+            url_key = self._url_key(url)
+            self._index[url_key] = (content_hash, row)
+            self._pending_keys.append(f'{url_key}\t{content_hash}\t{row}\n')
+
+    def flush(self):
+        """Persist new entries; vectors are flushed before their keys so a crash never indexes garbage"""
+        if self.read_only:
+            return
+        with self._lock:
+            self.embeddings.flush()
+            if self._pending_keys:
+                with open(os.path.join(self.path, self.keys_file), 'a') as keys:
+                    keys.writelines(self._pending_keys)
+                self._pending_keys = []
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,165 @@
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from loguru import logger
+from transformers import CLIPModel, CLIPTextModelWithProjection, CLIPVisionModelWithProjection, PreTrainedModel
+
+
+def _text_features(model: PreTrainedModel, input_ids, attention_mask):
+    # the full model and the standalone tower expose the projected features differently
+    if isinstance(model, CLIPModel):
+        return model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+    return model(input_ids=input_ids, attention_mask=attention_mask).text_embeds
+
+
+def _image_features(model: PreTrainedModel, pixel_values):
+    if isinstance(model, CLIPModel):
+        return model.get_image_features(pixel_values=pixel_values)
+    return model(pixel_values=pixel_values).image_embeds
+
+
+def _towers(model: PreTrainedModel) -> List[str]:
+    if isinstance(model, CLIPModel):
+        return ['text', 'vision']
+    if isinstance(model, CLIPTextModelWithProjection):
+        return ['text']
+    if isinstance(model, CLIPVisionModelWithProjection):
+        return ['vision']
+    raise ValueError(f'Unsupported model {type(model).__name__}')
+
+
+class TorchBackend:
+    """Runs the CLIP towers with PyTorch"""
+
+    def __init__(self, model: PreTrainedModel, device: str = 'cpu'):
+        self.model = model
+        self.device = device
+
+    def text_features(self, inputs: Dict[str, np.ndarray]) -> np.ndarray:
+        inputs = {k: torch.as_tensor(v).to(self.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            return _text_features(self.model, inputs['input_ids'], inputs.get('attention_mask')).cpu().numpy()
+
+    def image_features(self, pixel_values: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return _image_features(self.model, torch.as_tensor(pixel_values).to(self.device)).cpu().numpy()
+
+
+class _TextTower(torch.nn.Module):
+    def __init__(self, model: PreTrainedModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return _text_features(self.model, input_ids, attention_mask)
+
+
+class _VisionTower(torch.nn.Module):
+    def __init__(self, model: PreTrainedModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return _image_features(self.model, pixel_values)
+
+
+class OnnxBackend:
+    """
+    Runs the CLIP towers with ONNX Runtime on CPU.
+
+    The text and vision towers are exported once to `export_dir/<model name>/` and reused on later
+    starts. With `quantize` the exported graphs are dynamically quantized to int8 weights.
+    """
+
+    def __init__(self,
+                 model: PreTrainedModel,
+                 model_name: str,
+                 export_dir: str = 'data/onnx',
+                 quantize: bool = False,
+                 num_threads: Optional[int] = None,
+                 opset: int = 17):
+        """
+        Args:
+            model (PreTrainedModel): PyTorch model (or single tower) the towers are exported from
+            model_name (str): Name of the model, used to key the exported files
+            export_dir (str): Directory of the exported ONNX graphs
+            quantize (bool): Use dynamically int8-quantized graphs
+            num_threads (int): Intra-op threads of the inference sessions, defaults to torch's setting
+            opset (int): ONNX opset used for the export
+        """
+        import onnxruntime
+
+        self.path = os.path.join(export_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name))
+        os.makedirs(self.path, exist_ok=True)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.sessions = {}
+        for tower in _towers(model):
+            graph_path = self._export(model, tower, opset)
+            if quantize:
+                graph_path = self._quantize(graph_path)
+            self.sessions[tower] = onnxruntime.InferenceSession(graph_path,
+                                                                sess_options=session_options,
+                                                                providers=['CPUExecutionProvider'])
+
+    def _export(self, model: PreTrainedModel, tower: str, opset: int) -> str:
+        graph_path = os.path.join(self.path, f'{tower}.onnx')
+        if os.path.exists(graph_path):
+            return graph_path
+
+        logger.info(f'exporting the {tower} tower to {graph_path}')
+        model = model.cpu().eval()
+        if tower == 'text':
+            module, input_names = _TextTower(model), ['input_ids', 'attention_mask']
+            sample_inputs = (torch.ones((2, 8), dtype=torch.long), torch.ones((2, 8), dtype=torch.long))
+            dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'},
+                            'attention_mask': {0: 'batch', 1: 'sequence'},
+                            'features': {0: 'batch'}}
+        else:
+            vision_config = model.config.vision_config if isinstance(model, CLIPModel) else model.config
+            image_size = vision_config.image_size
+            module, input_names = _VisionTower(model), ['pixel_values']
+            sample_inputs = (torch.zeros((2, 3, image_size, image_size)),)
+            dynamic_axes = {'pixel_values': {0: 'batch'}, 'features': {0: 'batch'}}
+
+        with torch.no_grad():
+            torch.onnx.export(module, sample_inputs, graph_path,
+                              input_names=input_names,
+                              output_names=['features'],
+                              dynamic_axes=dynamic_axes,
+                              opset_version=opset,
+                              dynamo=False)
+        return graph_path
+
+    @staticmethod
+    def _quantize(graph_path: str) -> str:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantized_path = graph_path.replace('.onnx', '.int8.onnx')
+        if not os.path.exists(quantized_path):
+            logger.info(f'quantizing {graph_path} to int8')
+            quantize_dynamic(graph_path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+
+    def text_features(self, inputs: Dict[str, np.ndarray]) -> np.ndarray:
+        return self.sessions['text'].run(None, {
+            'input_ids': np.asarray(inputs['input_ids'], dtype=np.int64),
+            'attention_mask': np.asarray(inputs['attention_mask'], dtype=np.int64),
+        })[0]
+
+    def image_features(self, pixel_values: np.ndarray) -> np.ndarray:
+        return self.sessions['vision'].run(None, {'pixel_values': np.asarray(pixel_values, dtype=np.float32)})[0]
+
+
+def create_backend(backend: str, model: PreTrainedModel, model_name: str, device: str = 'cpu', **backend_configs):
+    if backend == 'torch':
+        return TorchBackend(model, device)
+    if backend == 'onnx':
+        return OnnxBackend(model, model_name, **backend_configs)
+    raise ValueError(f'Unsupported encoder backend {backend}')
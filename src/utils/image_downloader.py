@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.embedding_cache import content_hash
+from utils.image_preprocessing import decode_image
+from utils.metrics import count_indexed, indexer_stage
+
+
+class ImageDownloader:
+    def __init__(self,
+                 max_workers: int = 16,
+                 per_host_limit: int = 8,
+                 timeout: float = 10.0,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 draft_size: Optional[int] = None):
+        """
+        Concurrent image downloader backed by a pooled keep-alive session.
+
+        Args:
+            max_workers (int): Number of download threads
+            per_host_limit (int): Maximum number of in-flight requests per host
+            timeout (float): Connect/read timeout of a single request in seconds
+            max_retries (int): Number of retries on connection errors and 429/5xx responses
+            backoff_factor (float): Exponential backoff factor between retries
+            draft_size (int): Decode JPEGs at a reduced scale whose shortest side is at least this size
+        """
+        self.max_workers = max_workers
+        self.draft_size = draft_size
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']))
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=max(max_workers, per_host_limit),
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._host_semaphores: Dict[str, BoundedSemaphore] = {}
+        self._lock = Lock()
+
+    def _host_semaphore(self, url: str) -> BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = BoundedSemaphore(self.per_host_limit)
+            return self._host_semaphores[host]
+
+    def fetch(self, url: str) -> bytes:
+        """
+        Download the raw bytes of an image.
+
+        Raises:
+            ValueError: If the image cannot be downloaded
+        """
+        try:
+            with indexer_stage('download'):
+                with self._host_semaphore(url):
+                    response = self.session.get(url, timeout=self.timeout)
+                response.raise_for_status()
+            count_indexed('download')
+            return response.content
+        except Exception as e:
+            raise ValueError(f"Failed to load image from URL: {str(e)}")
+
+    def decode(self, content: bytes) -> Image.Image:
+        try:
+            with indexer_stage('decode'):
+                image = decode_image(content, self.draft_size)
+            count_indexed('decode')
+            return image
+        except Exception as e:
+            raise ValueError(f"Failed to decode image: {str(e)}")
+
+    def load(self, url: str) -> Image.Image:
+        return self.decode(self.fetch(url))
+
+    def load_with_hash(self, url: str) -> Tuple[Image.Image, str]:
+        content = self.fetch(url)
+        return self.decode(content), content_hash(content)
+
+    def submit(self, url: str, with_hash: bool = False) -> Future:
+        """
+        Schedule download and decoding of an image on the worker pool.
+
+        Args:
+            url (str): URL of the image
+            with_hash (bool): Also return the hash of the downloaded bytes
+
+        Returns:
+            Future: Resolves to the decoded PIL.Image (or an (image, content_hash) tuple) or raises ValueError
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='image-downloader')
+        return self._executor.submit(self.load_with_hash if with_hash else self.load, url)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self.session.close()
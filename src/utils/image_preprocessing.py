@@ -0,0 +1,78 @@
+from io import BytesIO
+from typing import List, Optional, Sequence
+
+import numpy as np
+from PIL import Image
+
+
+def decode_image(content: bytes, draft_size: Optional[int] = None) -> Image.Image:
+    """
+    Decode an image to RGB. With `draft_size`, JPEGs are decoded at the smallest DCT scale
+    (1/2, 1/4 or 1/8) that keeps their shortest side at least `draft_size` pixels,
+    which skips most of the decoding work for large photos that are downscaled anyway.
+    """
+    image = Image.open(BytesIO(content))
+    if draft_size is not None and image.format == 'JPEG':
+        scale = draft_size / min(image.size)
+        if scale < 1:
+            image.draft('RGB', (int(np.ceil(image.width * scale)), int(np.ceil(image.height * scale))))
+    return image.convert('RGB')
+
+
+class ImagePreprocessor:
+    """
+    NumPy implementation of the CLIP image preprocessing: resize of the shortest side, center crop,
+    rescale and normalization of a whole batch at once. Produces the `pixel_values` of
+    `CLIPImageProcessor` without its per-image conversions between PIL and float arrays.
+    """
+
+    def __init__(self,
+                 size: int = 224,
+                 crop_size: int = 224,
+                 image_mean: Sequence[float] = (0.48145466, 0.4578275, 0.40821073),
+                 image_std: Sequence[float] = (0.26862954, 0.26130258, 0.27577711),
+                 resample: int = Image.BICUBIC):
+        """
+        Args:
+            size (int): Length the shortest side of the images is resized to
+            crop_size (int): Side of the square center crop fed to the model
+            image_mean (Sequence[float]): Per-channel mean of the normalization
+            image_std (Sequence[float]): Per-channel standard deviation of the normalization
+            resample (int): PIL resampling filter of the resize
+        """
+        self.size = size
+        self.crop_size = crop_size
+        self.resample = resample
+        # folds the 1/255 rescale into the normalization: (x / 255 - mean) / std = x * scale - shift
+        std = np.asarray(image_std, dtype=np.float32)
+        self._scale = (1 / (255 * std)).reshape(1, 3, 1, 1)
+        self._shift = (np.asarray(image_mean, dtype=np.float32) / std).reshape(1, 3, 1, 1)
+
+    @classmethod
+    def from_image_processor(cls, image_processor) -> 'ImagePreprocessor':
+        return cls(size=image_processor.size['shortest_edge'],
+                   crop_size=image_processor.crop_size['height'],
+                   image_mean=image_processor.image_mean,
+                   image_std=image_processor.image_std,
+                   resample=image_processor.resample)
+
+    def resize_and_crop(self, image: Image.Image) -> np.ndarray:
+        """Resize the shortest side to `size` and center crop, returns a (crop_size, crop_size, 3) uint8 array"""
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        width, height = image.size
+        if width <= height:
+            new_size = (self.size, int(self.size * height / width))
+        else:
+            new_size = (int(self.size * width / height), self.size)
+        if new_size != image.size:
+            image = image.resize(new_size, resample=self.resample)
+
+        left = int((new_size[0] - self.crop_size) / 2)
+        top = int((new_size[1] - self.crop_size) / 2)
+        return np.asarray(image.crop((left, top, left + self.crop_size, top + self.crop_size)))
+
+    def __call__(self, images: List[Image.Image]) -> np.ndarray:
+        """Preprocess a batch of images into normalized (batch, 3, crop_size, crop_size) float32 pixel values"""
+        batch = np.stack([self.resize_and_crop(image) for image in images]).transpose(0, 3, 1, 2)
+        return batch.astype(np.float32) * self._scale - self._shift
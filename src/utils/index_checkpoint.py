@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
+from loguru import logger
+
+from models.product import Product
+
+
+class IndexCheckpoint:
+    """
+    Record of the products that are already indexed, used to compute the delta of a catalog sync.
+
+    Entries are appended to a JSON Lines log (one `{"id", "updated_at", "payload_hash", "images_hash"}`
+    line per processed product, `{"id", "deleted": true}` for removed ones), so a crashed job resumes
+    from the last flushed batch. `compact` rewrites the log with only the live entries.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[int, Dict] = {}
+        self._pending: List[Dict] = []
+        self._lock = Lock()
+        self.load(path)
+
+    @staticmethod
+    def payload_hash(product: Product) -> str:
+        # only fields present in the feed, defaults like `updated_at=utcnow()` would change every run
+        payload = json.dumps(product.model_dump(exclude_unset=True, mode='json'), sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def images_hash(product: Product) -> str:
+        return hashlib.sha1('\n'.join(product.images).encode('utf-8')).hexdigest()
+
+    def load(self, path: str):
+        """Apply the log at `path` on top of the entries, e.g. the checkpoint of another shard layout"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as log:
+            for line in log:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written line of an interrupted run
+                    continue
+                if entry.get('deleted'):
+                    self.entries.pop(entry['id'], None)
+                else:
+                    self.entries[entry['id']] = entry
+        logger.info(f'loaded checkpoint of {len(self.entries)} products from {path}')
+
+    def get(self, product_id: int) -> Optional[Dict]:
+        return self.entries.get(product_id)
+
+    def indexed_ids(self) -> List[int]:
+        """Snapshot of the ids of the indexed products, safe while upload threads mark products indexed"""
+        with self._lock:
+            return list(self.entries)
+
+    def mark_indexed(self, products: Iterable[Product]):
+        with self._lock:
+            for product in products:
+                entry = {'id': product.id,
+                         'updated_at': product.updated_at.isoformat(),
+                         'payload_hash': self.payload_hash(product),
+                         'images_hash': self.images_hash(product)}
+                self.entries[product.id] = entry
+                self._pending.append(entry)
+
+    def mark_deleted(self, product_ids: Iterable[int]):
+        with self._lock:
+            for product_id in product_ids:
+                self.entries.pop(product_id, None)
+                self._pending.append({'id': product_id, 'deleted': True})
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as log:
+                log.writelines(json.dumps(entry) + '\n' for entry in self._pending)
+            self._pending = []
+
+    def compact(self):
+        self.flush()
+        with self._lock:
+            self.write_entries(self.path, self.entries.values())
+
+    @staticmethod
+    def write_entries(path: str, entries: Iterable[Dict]):
+        """Replace the log at `path` with `entries`"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as log:
+            log.writelines(json.dumps(entry) + '\n' for entry in entries)
+        os.replace(tmp_path, path)
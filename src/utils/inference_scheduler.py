@@ -0,0 +1,101 @@
+import os
+import queue
+import time
+from concurrent.futures import Future
+from threading import Thread, Lock
+from typing import Dict, List
+
+from loguru import logger
+
+from utils.clip_encoder import CLIPEncoder
+from utils.metrics import Histogram
+
+
+class TextEncodingScheduler:
+    """
+    Micro-batching front of `CLIPEncoder.encode_text`.
+
+    Concurrent callers enqueue their text and block on a future; a single worker thread collects
+    requests for up to `max_wait_ms` or `max_batch_size` items and runs them as one padded batch.
+    """
+
+    def __init__(self, clip_encoder: CLIPEncoder, max_batch_size: int = 16, max_wait_ms: float = 5):
+        """
+        Args:
+            clip_encoder (CLIPEncoder): Encoder running the batched forward passes
+            max_batch_size (int): Maximum number of texts per forward pass
+            max_wait_ms (float): Maximum time the first request of a batch waits for others
+        """
+        self.clip_encoder = clip_encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+        self._worker_pid = None
+        self._lock = Lock()
+
+        self.batch_sizes = Histogram(buckets=[1, 2, 4, 8, 16, 32, 64])
+        self.queue_depths = Histogram(buckets=[0, 1, 2, 4, 8, 16, 32, 64, 128])
+
+    def _ensure_worker(self):
+        # threads don't survive a fork, so every (pre-forked) server worker starts its own
+        if self._worker_pid != os.getpid():
+            with self._lock:
+                if self._worker_pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._worker = Thread(target=self._run, args=(self._queue,),
+                                          name='text-encoding-scheduler', daemon=True)
+                    self._worker.start()
+                    self._worker_pid = os.getpid()
+
+    def encode_text(self, text: str) -> List[float]:
+        text_cache = self.clip_encoder.text_cache
+        if text_cache is not None:
+            # cache hits never wait in the queue
+            text_embedding = text_cache.get(self.clip_encoder.normalize_text(text))
+            if text_embedding is not None:
+                return text_embedding
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _collect_batch(self, requests: queue.Queue):
+        batch = [requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, requests: queue.Queue):
+        while True:
+            batch = self._collect_batch(requests)
+            self.queue_depths.observe(requests.qsize())
+            self.batch_sizes.observe(len(batch))
+
+            try:
+                # cache misses were already counted when the texts were submitted
+                text_embeddings = self.clip_encoder.encode_texts([text for text, _ in batch], lookup_cache=False)
+            except Exception as e:
+                logger.error(f'error encoding a batch of {len(batch)} texts')
+                logger.error(e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), text_embedding in zip(batch, text_embeddings):
+                future.set_result(text_embedding)
+
+    def stats(self) -> Dict:
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'queue_depths': self.queue_depths.snapshot(),
+            'batch_sizes': self.batch_sizes.snapshot(),
+        }
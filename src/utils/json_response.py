@@ -0,0 +1,19 @@
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used without it
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(obj, status: int = 200) -> Response:
+    """JSON response encoded with orjson when it is installed, a faster drop-in for `jsonify` on hot paths"""
+    return Response(dumps(obj), status=status, mimetype='application/json')
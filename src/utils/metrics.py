@@ -0,0 +1,184 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+
+class Histogram:
+    """Thread-safe histogram with fixed upper-bound buckets"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self) -> Dict:
+        """Cumulative bucket counts keyed by their upper bound, like Prometheus `le` buckets"""
+        with self._lock:
+            cumulative, buckets = 0, {}
+            for upper_bound, count in zip(self.buckets + [float('inf')], self._counts):
+                cumulative += count
+                buckets[str(upper_bound)] = cumulative
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'buckets': buckets,
+            }
+
+
+class Counter:
+    """Thread-safe monotonically increasing counter"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+STAGE_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class MetricsRegistry:
+    """
+    Process-wide collection of metrics rendered in the Prometheus text exposition format.
+    Metrics are identified by their name and labels; pre-forked server workers each hold their own.
+    """
+    registry = None
+
+    @staticmethod
+    def get_registry():
+        if MetricsRegistry.registry is None:
+            MetricsRegistry.registry = MetricsRegistry()
+        return MetricsRegistry.registry
+
+    def __init__(self):
+        self._metrics: Dict[str, Dict] = {}
+        self._lock = Lock()
+
+    def _get(self, name: str, metric_type: str, help_text: str, labels: Dict, factory: Callable):
+        key = tuple(sorted(labels.items()))
+        family = self._metrics.get(name)
+        if family is None or key not in family['metrics']:
+            with self._lock:
+                family = self._metrics.setdefault(name, {'type': metric_type, 'help': help_text, 'metrics': {}})
+                if key not in family['metrics']:
+                    family['metrics'][key] = factory()
+        return family['metrics'][key]
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = STAGE_BUCKETS, **labels) -> Histogram:
+        return self._get(name, 'histogram', help_text, labels, lambda: Histogram(buckets))
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._get(name, 'counter', help_text, labels, Counter)
+
+    def register(self, name: str, help_text: str, metric_type: str, metric, **labels):
+        """
+        Expose a metric owned elsewhere: a `Histogram`, a `Counter` or a callable returning
+        the current value of a `gauge` (or `counter`).
+        """
+        self._get(name, metric_type, help_text, labels, lambda: metric)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            families = {name: dict(family, metrics=dict(family['metrics']))
+                        for name, family in self._metrics.items()}
+        for name, family in sorted(families.items()):
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family["type"]}')
+            for labels, metric in family['metrics'].items():
+                if isinstance(metric, Histogram):
+                    snapshot = metric.snapshot()
+                    for upper_bound, count in snapshot['buckets'].items():
+                        le = '+Inf' if upper_bound == 'inf' else upper_bound
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {snapshot["sum"]}')
+                    lines.append(f'{name}_count{_labels(labels)} {snapshot["count"]}')
+                else:
+                    value = metric.value if isinstance(metric, Counter) else metric()
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str):
+        """Write the metrics of a batch job for the textfile collector of the node exporter"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f'{path}.tmp', 'w') as textfile:
+            textfile.write(self.render())
+        os.replace(f'{path}.tmp', path)
+
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# stage durations of the request being handled, set by `request_timings`
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('request_timings', default=None)
+# the legs of a hybrid search time their stages from their own threads
+_request_timings_lock = Lock()
+
+
+@contextmanager
+def request_timings():
+    """Collect the durations of the stages timed while handling a request, in seconds"""
+    timings = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+@contextmanager
+def timed(stage: str, metric: str = 'search_stage_seconds', help_text: str = 'Duration of the stages of a search'):
+    """Time a stage into the `metric` histogram and the timings of the current request"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        MetricsRegistry.get_registry().histogram(metric, help_text, stage=stage).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            with _request_timings_lock:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def encoder_stage(stage: str):
+    """Time a stage of the CLIP encoder"""
+    return timed(stage, 'encoder_stage_seconds', 'Duration of the stages of the CLIP encoder')
+
+
+def indexer_stage(stage: str):
+    """Time a stage of the indexing job"""
+    return timed(stage, 'indexer_stage_seconds', 'Duration of the stages of the indexing job')
+
+
+def count_indexed(stage: str, amount: int = 1):
+    """Count the items (images or points) that went through a stage of the indexing job"""
+    MetricsRegistry.get_registry().counter('indexer_items_total',
+                                           'Items processed by the stages of the indexing job',
+                                           stage=stage).inc(amount)
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """`Server-Timing` header value of the stage timings, in milliseconds"""
+    return ', '.join(f'{stage};dur={elapsed * 1000:.2f}' for stage, elapsed in timings.items())
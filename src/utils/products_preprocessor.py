@@ -1,4 +1,5 @@
-from typing import List, Dict, Optional
+import json
+from typing import List, Dict, Optional, Iterator, TextIO
 from pydantic_core._pydantic_core import ValidationError
 from models.product import Product
 from loguru import logger
@@ -17,11 +18,73 @@ class ProductsPreprocessor:
         self.__initialize_products()
 
     def __initialize_products(self):
-        def create_product(product: Dict):
+        self.products = [self._create_product(product) for product in self.products_list]
+        self.products = [product for product in self.products if product is not None]
+
+    @staticmethod
+    def _create_product(product: Dict) -> Optional[Product]:
+        try:
+            return Product(**product)
+        except ValidationError as e:
+            logger.error('Validation Error while creating product {product}'.format(product=product))
+        except TypeError:
+            # a record that isn't a JSON object
+            logger.error('Skipping product record {product}, expected an object'.format(product=product))
+
+    def iter_products(self, path: str, read_size: int = 1 << 20) -> Iterator[Product]:
+        """
+        Stream products from a JSON array or JSON Lines file, validating them lazily,
+        so memory stays flat regardless of the catalog size.
+
+        Args:
+            path (str): Path of the products file
+            read_size (int): Number of characters read from the file at a time
+        """
+        with open(path, 'r') as products_file:
+            for product in self._iter_json_records(products_file, read_size):
+                product = self._create_product(product)
+                if product is not None:
+                    yield product
+
+    @staticmethod
+    def _iter_json_records(products_file: TextIO, read_size: int) -> Iterator[Dict]:
+        decoder = json.JSONDecoder()
+        buffer, position = '', 0
+        in_array = None
+
+        while True:
+            # skip separators, reading more of the file when the buffer runs out
+            while position < len(buffer) and (buffer[position].isspace() or (in_array and buffer[position] == ',')):
+                position += 1
+            if position >= len(buffer):
+                chunk = products_file.read(read_size)
+                if not chunk:
+                    if in_array:
+                        raise ValueError('Unexpected end of products file, missing closing bracket')
+                    return
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+
+            if in_array is None:
+                # a JSON array starts with `[`, anything else is read as JSON Lines
+                in_array = buffer[position] == '['
+                if in_array:
+                    position += 1
+                continue
+
+            if in_array and buffer[position] == ']':
+                return
+
             try:
-                return Product(**product)
-            except ValidationError as e:
-                logger.error('Validation Error while creating product {product}'.format(product=product))
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = products_file.read(read_size)
+                if not chunk:
+                    raise
+                buffer, position = buffer[position:] + chunk, 0
+                continue
 
-        self.products = [create_product(product) for product in self.products_list]
-        self.products = [product for product in self.products if product is not None]
+            yield record
+            position = end
+            if position > read_size:
+                buffer, position = buffer[position:], 0
@@ -0,0 +1,82 @@
+from typing import Callable, Dict, Hashable, List, Optional, Sequence
+
+
+def _product_key(result: Dict) -> Hashable:
+    return result['product'].uuid
+
+
+def reciprocal_rank_fusion(ranked_lists: Sequence[List[Dict]],
+                           top_k: int,
+                           k: int = 60,
+                           weights: Optional[Sequence[float]] = None,
+                           key: Callable[[Dict], Hashable] = _product_key) -> List[Dict]:
+    """
+    Fuse ranked result lists with (weighted) reciprocal rank fusion: score(d) = sum_i w_i / (k + rank_i(d)).
+
+    Args:
+        ranked_lists: Result lists, each ordered from the best to the worst result
+        top_k (int): Number of fused results to return
+        k (int): Rank smoothing constant, larger values flatten the contribution of top ranks
+        weights: Weight of every list, defaults to 1 for all
+        key: Identity of a result used to merge duplicates across lists
+    """
+    weights = weights or [1.0] * len(ranked_lists)
+    scores: Dict[Hashable, float] = {}
+    results: Dict[Hashable, Dict] = {}
+    for ranked_list, weight in zip(ranked_lists, weights):
+        for rank, result in enumerate(ranked_list, start=1):
+            result_key = key(result)
+            scores[result_key] = scores.get(result_key, 0.0) + weight / (k + rank)
+            results.setdefault(result_key, result)
+
+    fused = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [{**results[result_key], 'fusion_score': scores[result_key]} for result_key in fused]
+
+
+def weighted_score_fusion(ranked_lists: Sequence[List[Dict]],
+                          top_k: int,
+                          weights: Optional[Sequence[float]] = None,
+                          key: Callable[[Dict], Hashable] = _product_key) -> List[Dict]:
+    """
+    Fuse result lists by a weighted sum of min-max normalized scores.
+    Results are scored by their `similarity_score` or BM25 `keyword_score`, those without either
+    (e.g. unranked keyword matches) by their position.
+    """
+    weights = weights or [1.0] * len(ranked_lists)
+    scores: Dict[Hashable, float] = {}
+    results: Dict[Hashable, Dict] = {}
+    for ranked_list, weight in zip(ranked_lists, weights):
+        if not ranked_list:
+            continue
+        raw_scores = [result.get('similarity_score', result.get('keyword_score', 1.0 / rank))
+                      for rank, result in enumerate(ranked_list, start=1)]
+        low, high = min(raw_scores), max(raw_scores)
+        for result, raw_score in zip(ranked_list, raw_scores):
+            normalized = (raw_score - low) / (high - low) if high > low else 1.0
+            result_key = key(result)
+            scores[result_key] = scores.get(result_key, 0.0) + weight * normalized
+            results.setdefault(result_key, result)
+
+    fused = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [{**results[result_key], 'fusion_score': scores[result_key]} for result_key in fused]
+
+
+def percent_fusion(semantic_results: List[Dict],
+                   keyword_results: List[Dict],
+                   top_k: int,
+                   semantic_results_percent: int = 50,
+                   key: Callable[[Dict], Hashable] = _product_key) -> List[Dict]:
+    """
+    Take a fixed share of the top semantic results, fill up with keyword results and then
+    with the remaining semantic ones, skipping duplicates.
+    """
+    semantic_share = int(top_k * semantic_results_percent / 100)
+    seen, results = set(), []
+    for result in semantic_results[:semantic_share] + keyword_results + semantic_results[semantic_share:]:
+        if len(results) >= top_k:
+            break
+        result_key = key(result)
+        if result_key not in seen:
+            seen.add(result_key)
+            results.append(result)
+    return results
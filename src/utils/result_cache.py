@@ -0,0 +1,181 @@
+import hashlib
+import os
+import time
+from threading import Lock
+from typing import Dict, Optional
+
+from loguru import logger
+
+from utils.lru_cache import LRUCache
+
+
+def _redis_client(redis_url: str):
+    import redis
+
+    return redis.Redis.from_url(redis_url)
+
+
+class CatalogVersion:
+    """
+    Opaque version of the indexed catalog, changed by every write of the indexing job.
+
+    The version lives in redis when `redis_url` is set, otherwise in the file at `path`, so the
+    indexing job and the serving processes see the same one. Without either it is only known to
+    the current process. Readers cache it for `check_interval` seconds.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 redis_url: Optional[str] = None,
+                 key: str = 'clip-search:catalog-version',
+                 check_interval: float = 1.0):
+        self.path = path
+        self.key = key
+        self.check_interval = check_interval
+        self._redis = _redis_client(redis_url) if redis_url else None
+        self._lock = Lock()
+        self._version: Optional[str] = None
+        self._checked_at = float('-inf')
+
+    @classmethod
+    def from_configs(cls, configs: Optional[Dict]) -> 'CatalogVersion':
+        configs = configs or {}
+        return cls(path=configs.get('catalog_version_path'),
+                   redis_url=configs.get('redis_url'),
+                   check_interval=configs.get('version_check_interval_ms', 1000) / 1000)
+
+    def _read(self) -> str:
+        if self._redis is not None:
+            version = self._redis.get(self.key)
+            return version.decode() if version is not None else '0'
+        if self.path is not None:
+            try:
+                with open(self.path, 'r') as version_file:
+                    return version_file.read().strip()
+            except FileNotFoundError:
+                return '0'
+        return self._version or '0'
+
+    def get(self) -> str:
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            try:
+                version = self._read()
+            except Exception as e:
+                # keeps serving with the last known version
+                logger.warning(f'could not read the catalog version: {e}')
+                version = self._version or '0'
+            with self._lock:
+                self._version, self._checked_at = version, now
+        return self._version
+
+    def bump(self) -> str:
+        if self._redis is not None:
+            version = str(self._redis.incr(self.key))
+        else:
+            # distinct across processes writing the same file, unlike a read-modify-write counter
+            version = str(time.time_ns())
+            if self.path is not None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(f'{self.path}.{os.getpid()}.tmp', 'w') as version_file:
+                    version_file.write(version)
+                os.replace(f'{self.path}.{os.getpid()}.tmp', self.path)
+        with self._lock:
+            self._version, self._checked_at = version, time.monotonic()
+        return version
+
+
+class ResultCache:
+    """
+    Cache of serialized search responses, tagged with the catalog version they were computed at.
+
+    Pages live in an in-process LRU and, with `redis_url`, in redis shared by all serving processes.
+    A page of another catalog version is never served: the LRU is dropped when the version changes
+    and redis keys embed the version (old ones expire with `ttl`).
+    """
+
+    def __init__(self,
+                 catalog_version: CatalogVersion,
+                 max_size: int = 10000,
+                 ttl: Optional[float] = 600,
+                 redis_url: Optional[str] = None,
+                 key_prefix: str = 'clip-search:page'):
+        """
+        Args:
+            catalog_version (CatalogVersion): Version of the catalog the pages are valid for
+            max_size (int): Maximum number of pages in the in-process LRU
+            ttl (float): Seconds a page stays valid, None keeps pages until the catalog changes
+            redis_url (str): URL of a redis shared by the serving processes, None keeps pages in process only
+            key_prefix (str): Prefix of the redis keys of the pages
+        """
+        self.catalog_version = catalog_version
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self._pages = LRUCache(max_size=max_size, ttl=ttl)
+        self._pages_version: Optional[str] = None
+        self._lock = Lock()
+        self._redis = _redis_client(redis_url) if redis_url else None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_configs(cls, configs: Dict, catalog_version: Optional[CatalogVersion] = None) -> 'ResultCache':
+        return cls(catalog_version=catalog_version or CatalogVersion.from_configs(configs),
+                   max_size=configs.get('max_size', 10000),
+                   ttl=configs.get('ttl_seconds', 600),
+                   redis_url=configs.get('redis_url'))
+
+    def version(self) -> str:
+        """Current catalog version, pages computed at an older one are dropped"""
+        version = self.catalog_version.get()
+        if version != self._pages_version:
+            with self._lock:
+                if version != self._pages_version:
+                    self._pages.clear()
+                    self._pages_version = version
+        return version
+
+    def _redis_key(self, version: str, key: str) -> str:
+        return f'{self.key_prefix}:{version}:{hashlib.sha1(key.encode()).hexdigest()}'
+
+    def get(self, key: str) -> Optional[bytes]:
+        version = self.version()
+        page = self._pages.get((version, key))
+        if page is None and self._redis is not None:
+            try:
+                page = self._redis.get(self._redis_key(version, key))
+            except Exception as e:
+                logger.warning(f'result cache lookup failed: {e}')
+            if page is not None:
+                self._pages.put((version, key), page)
+
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return page
+
+    def put(self, key: str, page: bytes, version: str):
+        """Cache the page of `key` computed at catalog `version`, ignored if the catalog changed since"""
+        if version != self.version():
+            return
+        self._pages.put((version, key), page)
+        if self._redis is not None:
+            try:
+                self._redis.set(self._redis_key(version, key), page,
+                                ex=int(self.ttl) if self.ttl is not None else None)
+            except Exception as e:
+                logger.warning(f'result cache write failed: {e}')
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._pages),
+            'catalog_version': self._pages_version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
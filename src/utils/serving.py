@@ -0,0 +1,91 @@
+import gc
+import os
+from typing import Callable, Dict, Optional
+
+from flask import Flask
+from gunicorn.app.base import BaseApplication
+from loguru import logger
+
+
+def configure_torch_threads(num_workers: int, torch_threads: Optional[int] = None):
+    """
+    Split the cores between the worker processes so their intra-op pools don't oversubscribe the CPU.
+
+    Args:
+        num_workers (int): Number of processes running inference on this machine
+        torch_threads (int): Intra-op threads per process, defaults to cores / workers
+    """
+    # torch is only imported by the commands that run inference
+    import torch
+
+    torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // max(1, num_workers))
+    torch.set_num_threads(torch_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work started
+        pass
+    logger.info(f'using {torch_threads} torch threads per worker for {num_workers} workers')
+    return torch_threads
+
+
+def serve(create_app: Callable[[], Flask], server_configs: Dict, post_fork: Optional[Callable[[], None]] = None):
+    """
+    Run the application with the configured production server.
+
+    `gunicorn` builds the app (and loads the model) once in the master and forks the workers from it,
+    so the weights are shared copy-on-write. `waitress` serves it from a single multi-threaded process
+    and `flask` uses the development server.
+
+    Args:
+        create_app: Callable returning the Flask app
+        server_configs (Dict): The `server_configs` section of the configuration
+        post_fork: Called in every forked worker, e.g. to open connections that can't be shared
+    """
+    backend = server_configs.get('backend', 'gunicorn')
+    num_workers = server_configs.get('num_workers', 1) if backend == 'gunicorn' else 1
+    threads = server_configs.get('threads', 4)
+    torch_threads = configure_torch_threads(num_workers, server_configs.get('torch_threads'))
+
+    app = create_app()
+    if backend == 'gunicorn':
+        def on_post_fork(server, worker):
+            import torch
+
+            torch.set_num_threads(torch_threads)
+            if post_fork is not None:
+                post_fork()
+
+        GunicornApplication(app, {
+            'bind': f"0.0.0.0:{server_configs['port']}",
+            'workers': num_workers,
+            'threads': threads,
+            'worker_class': 'gthread',
+            'timeout': server_configs.get('timeout', 60),
+            'preload_app': True,
+            'post_fork': on_post_fork,
+        }).run()
+    elif backend == 'waitress':
+        from waitress import serve as waitress_serve
+
+        logger.info('Starting server...')
+        waitress_serve(app, host='0.0.0.0', port=server_configs['port'], threads=threads)
+    else:
+        app.run(host='0.0.0.0', port=server_configs['port'], threaded=True)
+
+
+class GunicornApplication(BaseApplication):
+    def __init__(self, app: Flask, options: Dict):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # objects allocated so far (model weights included) are never touched by the collector,
+        # which keeps the forked workers from copying the pages they live on
+        gc.freeze()
+        return self.application
@@ -0,0 +1,197 @@
+import glob
+import multiprocessing
+import os
+import queue
+import re
+from functools import partial
+from threading import Condition, Thread
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+from qdrant_client import models
+
+from utils.index_checkpoint import IndexCheckpoint
+from utils.upload_pipeline import UploadPipeline
+
+
+def shard_ids(shards: int, shard_index: int, processes: int) -> List[int]:
+    """
+    Global shards run by the `processes` local processes of machine `shard_index` out of `shards`.
+    The catalog is split into `shards * processes` shards by product id, and the global shards
+    `shard_index + shards * j` together hold exactly the products with `id % shards == shard_index`.
+    """
+    return [shard_index + shards * process for process in range(processes)]
+
+
+def in_shard(product_id: int, shard_index: int, shards: int) -> bool:
+    return product_id % shards == shard_index
+
+
+def shard_path(path: str, shard_index: int, shards: int) -> str:
+    return path if shards == 1 else f'{path}.shard-{shard_index}-of-{shards}'
+
+
+def shard_files(path: str) -> List[str]:
+    """Existing files (or directories) of `path` in any shard layout, oldest first"""
+    paths = [path] + [shard for shard in glob.glob(f'{glob.escape(path)}.shard-*')
+                      if re.fullmatch(r'\.shard-\d+-of-\d+', shard[len(path):])]
+    return sorted((path for path in paths if os.path.exists(path)), key=os.path.getmtime)
+
+
+def repartition_checkpoints(path: str, shards: List[int], total_shards: int):
+    """
+    Move the checkpoints of `path` written with another shard layout (e.g. a different number of
+    processes) into the checkpoints of `shards` out of `total_shards`, so changing the layout neither
+    re-embeds the catalog nor forgets the products to delete. Runs before the shards start.
+    """
+    targets = {shard_index: shard_path(path, shard_index, total_shards) for shard_index in shards}
+    existing = shard_files(path)
+    if set(existing) <= set(targets.values()):
+        return
+
+    logger.info(f'moving the checkpoints {existing} to the layout of {total_shards} shards')
+    # later logs win, the layouts were written one after the other
+    checkpoint = IndexCheckpoint(existing[0])
+    for checkpoint_path in existing[1:]:
+        checkpoint.load(checkpoint_path)
+
+    assigned = 0
+    for shard_index, target in targets.items():
+        entries = [entry for product_id, entry in checkpoint.entries.items()
+                   if in_shard(product_id, shard_index, total_shards)]
+        IndexCheckpoint.write_entries(target, entries)
+        assigned += len(entries)
+    if assigned < len(checkpoint.entries):
+        logger.warning(f'{len(checkpoint.entries) - assigned} checkpointed products belong to shards '
+                       f'of other machines, they are dropped from the checkpoints of this one')
+
+    for checkpoint_path in existing:
+        if checkpoint_path not in targets.values():
+            os.remove(checkpoint_path)
+
+
+class UploadClient:
+    """
+    Worker process side of the shared upload stage, with the `submit`/`close` interface of `UploadPipeline`.
+    Batches are sent to the `UploadPipeline` of the parent process, which acknowledges every one of them.
+    As in `UploadPipeline`, a failing callback is logged and raised again by `drain` and `close`.
+    """
+
+    def __init__(self, shard_index: int, upload_queue: multiprocessing.Queue, ack_queue: multiprocessing.Queue):
+        self.shard_index = shard_index
+        self._upload_queue = upload_queue
+        self._ack_queue = ack_queue
+        self._callbacks: Dict[int, tuple] = {}
+        self._next_batch_id = 0
+        self._pending = Condition()
+        self._callback_error: Optional[Exception] = None
+        self._ack_reader = Thread(target=self._read_acks, name='upload-acks', daemon=True)
+        self._ack_reader.start()
+
+    def submit(self,
+               points: List[models.PointStruct],
+               on_uploaded: Optional[Callable[[], None]] = None,
+               on_failed: Optional[Callable[[], None]] = None):
+        if not points:
+            return
+        with self._pending:
+            batch_id = self._next_batch_id
+            self._next_batch_id += 1
+            self._callbacks[batch_id] = (on_uploaded, on_failed)
+        # blocks while the shared queue is full
+        self._upload_queue.put((self.shard_index, batch_id, points))
+
+    def _read_acks(self):
+        while True:
+            ack = self._ack_queue.get()
+            if ack is None:
+                break
+            batch_id, uploaded = ack
+            with self._pending:
+                on_uploaded, on_failed = self._callbacks[batch_id]
+            callback = on_uploaded if uploaded else on_failed
+            error = None
+            try:
+                if callback is not None:
+                    callback()
+            except Exception as e:
+                # the reader keeps running, otherwise the batches left would never be acknowledged
+                logger.exception(f'callback of batch {batch_id} of shard {self.shard_index} failed')
+                error = e
+            # the batch is done once its callback has run
+            with self._pending:
+                del self._callbacks[batch_id]
+                if self._callback_error is None:
+                    self._callback_error = error
+                self._pending.notify_all()
+
+    def drain(self):
+        """Wait until every submitted batch is acknowledged and its callback has run"""
+        with self._pending:
+            self._pending.wait_for(lambda: not self._callbacks)
+        if self._callback_error is not None:
+            raise RuntimeError('a callback of an uploaded batch failed') from self._callback_error
+
+    def close(self):
+        """Wait until every submitted batch is acknowledged"""
+        try:
+            self.drain()
+        finally:
+            self._ack_queue.put(None)
+            self._ack_reader.join()
+
+
+def run_shards(index_shard: Callable,
+               shards: List[int],
+               total_shards: int,
+               upload_pipeline: UploadPipeline,
+               max_pending_batches: int = 8,
+               on_uploaded: Optional[Callable[[List[models.PointStruct]], None]] = None):
+    """
+    Run `index_shard(shard_index, total_shards, upload_queue, ack_queue)` in one process per shard and
+    upload the batches they submit to an `UploadClient(shard_index, upload_queue, ack_queue)` through
+    the `upload_pipeline` of this process. `on_uploaded` is called with the points of every uploaded batch.
+
+    Processes are spawned rather than forked, so every worker initializes torch and its
+    `CLIPEncoder` on its own. `index_shard` must be importable (a module level function).
+    """
+    context = multiprocessing.get_context('spawn')
+    upload_queue = context.Queue(maxsize=max_pending_batches)
+    ack_queues = {shard_index: context.Queue() for shard_index in shards}
+    processes = [context.Process(target=index_shard,
+                                 args=(shard_index, total_shards, upload_queue, ack_queues[shard_index]),
+                                 name=f'index-shard-{shard_index}')
+                 for shard_index in shards]
+    for process in processes:
+        process.start()
+    logger.info(f'indexing shards {shards} of {total_shards} in {len(processes)} processes')
+
+    def acknowledge(shard_index, batch_id, uploaded, points=None):
+        # the shard waits for the ack even if `on_uploaded` fails, `upload_pipeline.close` raises the error
+        try:
+            if uploaded and on_uploaded is not None:
+                on_uploaded(points)
+        finally:
+            ack_queues[shard_index].put((batch_id, uploaded))
+
+    try:
+        while True:
+            try:
+                shard_index, batch_id, points = upload_queue.get(timeout=0.5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            upload_pipeline.submit(points,
+                                   on_uploaded=partial(acknowledge, shard_index, batch_id, True, points),
+                                   on_failed=partial(acknowledge, shard_index, batch_id, False))
+    finally:
+        try:
+            upload_pipeline.close()
+        finally:
+            for process in processes:
+                process.join()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'indexing failed in {failed}')
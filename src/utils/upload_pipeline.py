@@ -0,0 +1,196 @@
+import json
+import os
+import queue
+import time
+from threading import Condition, Thread, Lock
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+from qdrant_client import QdrantClient, models
+
+from utils.metrics import count_indexed, indexer_stage
+
+
+class UploadPipeline:
+    """
+    Upload stage of the indexing job.
+
+    Batches of points are put on a bounded queue and upserted by `num_workers` threads with
+    `wait=False`, so encoding continues while uploads are in flight and blocks only once
+    `max_pending_batches` are waiting (backpressure). Upserts are idempotent (deterministic point
+    ids), so a failed batch is retried with exponential backoff and, once the retries are exhausted,
+    appended to a JSON Lines dead-letter file that `replay` uploads again. `drain` waits until every
+    submitted batch is uploaded (or dead-lettered) and its callback has run. `close` drains the queue
+    and ends with a `wait=True` upsert that returns once all acknowledged writes are applied.
+    A failing callback is logged without stopping the workers, and `drain` and `close` raise it
+    once the batches are done, so the job doesn't end as if every batch was recorded.
+    """
+
+    def __init__(self,
+                 client: QdrantClient,
+                 collection_name: str,
+                 num_workers: int = 4,
+                 max_pending_batches: int = 8,
+                 max_retries: int = 5,
+                 backoff_factor: float = 0.5,
+                 dead_letter_path: Optional[str] = None):
+        """
+        Args:
+            client (QdrantClient): Client the batches are upserted with
+            collection_name (str): Collection the points are written to
+            num_workers (int): Number of parallel upload threads
+            max_pending_batches (int): Queued batches after which `submit` blocks
+            max_retries (int): Retries of a failing batch before it's dead-lettered
+            backoff_factor (float): Base of the exponential backoff between retries, in seconds
+            dead_letter_path (str): JSON Lines file of the batches that could not be uploaded
+        """
+        self.client = client
+        self.collection_name = collection_name
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.dead_letter_path = dead_letter_path
+
+        self._queue = queue.Queue(maxsize=max_pending_batches)
+        self._lock = Lock()
+        self._last_batch: Optional[List[models.PointStruct]] = None
+        self._closed = False
+        # batches submitted but not done yet, callbacks included
+        self._in_flight = 0
+        self._done = Condition()
+        self._callback_error: Optional[Exception] = None
+        self.uploaded_batches, self.uploaded_points, self.retries, self.failed_batches = 0, 0, 0, 0
+
+        self._workers = [Thread(target=self._run, name=f'qdrant-upload-{index}', daemon=True)
+                         for index in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self,
+               points: List[models.PointStruct],
+               on_uploaded: Optional[Callable[[], None]] = None,
+               on_failed: Optional[Callable[[], None]] = None):
+        """
+        Queue a batch for upload. `on_uploaded` is called from the upload thread once it's written,
+        `on_failed` once it's dead-lettered.
+        """
+        if points:
+            with self._done:
+                self._in_flight += 1
+            self._queue.put((points, on_uploaded, on_failed))
+
+    def drain(self):
+        """Wait until every submitted batch is done, keeping the pipeline open"""
+        with self._done:
+            self._done.wait_for(lambda: self._in_flight == 0)
+        self._raise_callback_error()
+
+    def _raise_callback_error(self):
+        if self._callback_error is not None:
+            raise RuntimeError('a callback of an uploaded batch failed') from self._callback_error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            points, on_uploaded, on_failed = item
+            try:
+                if self._upload(points):
+                    callback = on_uploaded
+                else:
+                    self._dead_letter(points)
+                    callback = on_failed
+                if callback is not None:
+                    callback()
+            except Exception as e:
+                # the worker keeps running, otherwise `submit`, `drain` and `close` would block forever
+                logger.exception(f'callback of a batch of {len(points)} points failed')
+                with self._lock:
+                    if self._callback_error is None:
+                        self._callback_error = e
+            finally:
+                with self._done:
+                    self._in_flight -= 1
+                    self._done.notify_all()
+
+    def _upload(self, points: List[models.PointStruct]) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with indexer_stage('upsert'):
+                    self.client.upsert(collection_name=self.collection_name, points=points, wait=False)
+                count_indexed('upsert', len(points))
+                with self._lock:
+                    self.uploaded_batches += 1
+                    self.uploaded_points += len(points)
+                    self._last_batch = points
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f'failed to upload a batch of {len(points)} points')
+                    logger.error(e)
+                    return False
+                with self._lock:
+                    self.retries += 1
+                delay = self.backoff_factor * 2 ** attempt
+                logger.warning(f'upload of {len(points)} points failed, retrying in {delay:.1f}s: {e}')
+                time.sleep(delay)
+
+    def _dead_letter(self, points: List[models.PointStruct]):
+        count_indexed('dead_letter', len(points))
+        with self._lock:
+            self.failed_batches += 1
+            if self.dead_letter_path is None:
+                return
+            directory = os.path.dirname(self.dead_letter_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.dead_letter_path, 'a') as dead_letters:
+                batch = [point.model_dump(mode='json') for point in points]
+                dead_letters.write(json.dumps(batch, default=str) + '\n')
+
+    def close(self):
+        """
+        Upload the queued batches, stop the workers and wait until the written points are applied.
+        Raises `RuntimeError` if a callback failed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        if self._last_batch is not None:
+            # operations are applied in order, re-upserting a written batch with `wait=True` is the barrier
+            try:
+                self.client.upsert(collection_name=self.collection_name, points=self._last_batch, wait=True)
+            except Exception as e:
+                logger.error('failed to wait for the uploaded points to be applied')
+                logger.error(e)
+        logger.info(f'uploaded {self.uploaded_points} points in {self.uploaded_batches} batches, '
+                    f'{self.retries} retries, {self.failed_batches} failed batches')
+        self._raise_callback_error()
+
+    def stats(self) -> Dict:
+        return {'uploaded_batches': self.uploaded_batches,
+                'uploaded_points': self.uploaded_points,
+                'retries': self.retries,
+                'failed_batches': self.failed_batches,
+                'pending_batches': self._queue.qsize()}
+
+    def replay(self):
+        """
+        Upload the dead-lettered batches again and close the pipeline.
+        Batches failing again are written back to the dead-letter file.
+        """
+        if self.dead_letter_path is None or not os.path.exists(self.dead_letter_path):
+            return
+
+        replay_path = f'{self.dead_letter_path}.replay'
+        os.replace(self.dead_letter_path, replay_path)
+        with open(replay_path, 'r') as dead_letters:
+            for line in dead_letters:
+                self.submit([models.PointStruct(**point) for point in json.loads(line)])
+        self.close()
+        os.remove(replay_path)